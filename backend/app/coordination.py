@@ -0,0 +1,266 @@
+"""
+Coordination between worker processes (uvicorn/gunicorn --workers N).
+
+- Change log: writers append a `change_log` row in the same transaction as the
+  write. Every worker tails the table and dispatches to local subscribers, so
+  process-local caches are invalidated across workers. The committing worker
+  dispatches immediately after commit to keep read-your-writes. On Postgres,
+  ids are assigned at insert, not commit, so a lower id can become visible
+  after a higher one; skipped ids are re-polled for CHANGE_GAP_GRACE_S.
+- Startup lock: schema creation and backfills run under a cross-process lock.
+  The first worker does the work and the others find it already done.
+- Leadership: exactly one worker holds a lifetime lock and runs singleton
+  background jobs (layout, garbage collection). If it dies another takes over.
+
+Locks use flock on a file next to the database for SQLite, and advisory locks
+for Postgres.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import select, insert, delete, func, text, event, or_
+
+from . import config
+from .database import engine, AsyncSessionLocal, RoutingSession
+from .models import ChangeEvent
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str, Optional[int]], None]  # (topic, ref_id); ref_id None means "everything"
+
+STARTUP_LOCK_KEY = 0x0B51D1A1
+LEADER_LOCK_KEY = 0x0B51D1A2
+
+_handlers: Dict[str, List[Handler]] = {}
+_leadership_callbacks: List[Callable[[], Awaitable[None]]] = []
+_last_seen_id = 0
+_gaps: Dict[int, float] = {}  # Postgres: unseen ids below _last_seen_id -> when first skipped
+MAX_TRACKED_GAPS = 1000
+_watch_task: Optional[asyncio.Task] = None
+_leader_handle = None  # open lock file (SQLite) or checked-out connection (Postgres)
+_leader_tasks: List[asyncio.Task] = []
+
+
+# --- Change log ---
+
+def subscribe(topic: str, handler: Handler):
+    """Registers a synchronous, cheap handler (e.g. cache invalidation) for `topic`."""
+    _handlers.setdefault(topic, []).append(handler)
+
+
+def _dispatch(topic: str, ref_id: Optional[int]):
+    for handler in _handlers.get(topic, []):
+        try:
+            handler(topic, ref_id)
+        except Exception:
+            logger.exception("Change handler failed for %s:%s", topic, ref_id)
+
+
+def _dispatch_all():
+    for topic in list(_handlers):
+        _dispatch(topic, None)
+
+
+async def record_change(db, topic: str, ref_id: Optional[int] = None):
+    """
+    Appends a change event inside the caller's transaction.
+    Other workers pick it up on their next poll; this worker dispatches on commit.
+    """
+    await db.execute(insert(ChangeEvent).values(topic=topic, ref_id=ref_id))
+    db.info.setdefault("changes", []).append((topic, ref_id))
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _dispatch_committed(session):
+    for topic, ref_id in session.info.pop("changes", []):
+        _dispatch(topic, ref_id)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _drop_rolled_back(session):
+    session.info.pop("changes", None)
+
+
+async def _poll_changes():
+    global _last_seen_id
+    now = time.monotonic()
+    async with AsyncSessionLocal() as db:
+        oldest = (await db.execute(select(func.min(ChangeEvent.id)))).scalar()
+        if oldest is not None and oldest > _last_seen_id + 1:
+            # Events we never saw were pruned: drop all local state
+            _dispatch_all()
+        unseen = ChangeEvent.id > _last_seen_id
+        if _gaps:
+            unseen = or_(unseen, ChangeEvent.id.in_(list(_gaps)))
+        stmt = select(ChangeEvent.id, ChangeEvent.topic, ChangeEvent.ref_id)\
+            .where(unseen)\
+            .order_by(ChangeEvent.id)\
+            .limit(1000)
+        for event_id, topic, ref_id in await db.execute(stmt):
+            if event_id > _last_seen_id:
+                if config.DB_PROFILE == "postgres":
+                    # Skipped ids may belong to transactions that have not committed yet
+                    _gaps.update(dict.fromkeys(range(_last_seen_id + 1, event_id), now))
+                _last_seen_id = event_id
+            else:
+                del _gaps[event_id]
+            _dispatch(topic, ref_id)
+
+    # Still unseen after the grace window: most likely rolled back, but a slow
+    # transaction may commit later, so drop local state rather than risk staleness
+    expired = [event_id for event_id, since in _gaps.items() if now - since > config.CHANGE_GAP_GRACE_S]
+    for event_id in expired:
+        del _gaps[event_id]
+    if len(_gaps) > MAX_TRACKED_GAPS:
+        _gaps.clear()
+        expired = True
+    if expired:
+        _dispatch_all()
+
+
+async def _prune_changes():
+    cutoff = datetime.utcnow() - timedelta(seconds=config.CHANGE_LOG_RETENTION_S)
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(ChangeEvent).where(ChangeEvent.created_at < cutoff))
+        await db.commit()
+
+
+async def _watch():
+    last_prune = time.monotonic()
+    while True:
+        await asyncio.sleep(config.CHANGE_POLL_INTERVAL_MS / 1000)
+        try:
+            await _poll_changes()
+            if _leader_handle is None:
+                await _try_become_leader()
+            elif time.monotonic() - last_prune > 60:
+                await _prune_changes()
+                last_prune = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Change log poll failed")
+
+
+# --- Locks ---
+
+def _sqlite_lock_path(name: str) -> str:
+    return f"{os.path.abspath(engine.url.database)}.{name}.lock"
+
+
+@contextlib.asynccontextmanager
+async def startup_lock():
+    """Serializes one-time startup/migration work across workers."""
+    if config.DB_PROFILE == "sqlite":
+        import fcntl
+        fd = os.open(_sqlite_lock_path("startup"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+    else:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": STARTUP_LOCK_KEY})
+            try:
+                yield
+            finally:
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": STARTUP_LOCK_KEY})
+
+
+async def _try_become_leader() -> bool:
+    global _leader_handle
+    if _leader_handle is not None:
+        return True
+    if config.DB_PROFILE == "sqlite":
+        import fcntl
+        fd = os.open(_sqlite_lock_path("leader"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        _leader_handle = fd
+    else:
+        # Session-level advisory lock lives as long as this connection stays checked out
+        conn = await engine.connect()
+        acquired = (await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": LEADER_LOCK_KEY})).scalar()
+        await conn.commit()
+        if not acquired:
+            await conn.close()
+            return False
+        _leader_handle = conn
+
+    logger.info("Worker %s is the coordination leader", os.getpid())
+    for callback in _leadership_callbacks:
+        _leader_tasks.append(asyncio.create_task(callback()))
+    return True
+
+
+def is_leader() -> bool:
+    return _leader_handle is not None
+
+
+def on_leadership(callback: Callable[[], Awaitable[None]]):
+    """Runs `callback` (a coroutine function) in whichever worker becomes leader."""
+    _leadership_callbacks.append(callback)
+
+
+# --- Lifecycle ---
+
+async def start():
+    """Starts tailing the change log from its current end and competes for leadership."""
+    global _watch_task, _last_seen_id
+    async with AsyncSessionLocal() as db:
+        _last_seen_id = (await db.execute(select(func.max(ChangeEvent.id)))).scalar() or 0
+    await _try_become_leader()
+    _watch_task = asyncio.create_task(_watch())
+
+
+async def stop():
+    global _watch_task, _leader_handle
+    for task in [_watch_task, *_leader_tasks]:
+        if task is not None:
+            task.cancel()
+    _watch_task = None
+    _leader_tasks.clear()
+    if _leader_handle is not None:
+        if config.DB_PROFILE == "sqlite":
+            os.close(_leader_handle)
+        else:
+            await _leader_handle.close()
+        _leader_handle = None
+
+
+class LocalCache:
+    """
+    Process-local cache dropped whenever one of `topics` changes in any worker.
+
+    Callers read `version` before computing a value and pass it to `put`, so a
+    value computed from data that changed mid-flight is never stored.
+    """
+    def __init__(self, *topics: str):
+        self._data = {}
+        self.version = 0
+        for topic in topics:
+            subscribe(topic, self._invalidate)
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def put(self, key, value, version: int):
+        if version == self.version:
+            self._data[key] = value
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+    def _invalidate(self, topic: str, ref_id: Optional[int]):
+        self.clear()
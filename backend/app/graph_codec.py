@@ -0,0 +1,129 @@
+"""
+Compact columnar encoding of the graph (`GRAPH_BINARY_MEDIA_TYPE`).
+
+All integers and floats are little-endian and every section starts on a 4-byte
+boundary, so the browser can wrap them in typed arrays without copying.
+See design_docs/graph_binary_format.md for the full layout.
+
+Columns are built with NumPy. The only per-row Python work is UTF-8 encoding
+the titles.
+"""
+import gzip
+import struct
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # Optional: brotli is only offered when installed
+    brotli = None
+
+GRAPH_BINARY_MEDIA_TYPE = "application/vnd.corporate-obsidian.graph+binary"
+
+MAGIC = b"COG1"
+FLAG_POSITIONS = 1
+
+NODE_NOTE, NODE_TAG = 0, 1
+EDGE_NOTE_LINK, EDGE_TAG_LINK = 0, 1
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+def _string_table(strings: Sequence[str]) -> List[bytes]:
+    """uint32 offsets (len + 1) followed by the concatenated UTF-8 bytes."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+    return [offsets.tobytes(), _pad(b"".join(encoded))]
+
+
+def encode_graph(
+    node_ids: np.ndarray,
+    node_kinds: np.ndarray,
+    titles: Sequence[str],
+    groups: Sequence[str],
+    xs: np.ndarray,
+    ys: np.ndarray,
+    edge_sources: np.ndarray,
+    edge_targets: np.ndarray,
+    edge_kinds: np.ndarray,
+) -> bytes:
+    """
+    Packs node and edge columns into one buffer.
+
+    Edge endpoints are indices into the node columns. Missing positions are NaN.
+    """
+    n, m = len(node_ids), len(edge_sources)
+    group_names, group_index = np.unique(np.asarray(groups, dtype=object).astype(str), return_inverse=True)
+    if len(group_names) > 255:
+        raise ValueError("Binary graph encoding supports at most 255 node groups")
+    has_positions = n > 0 and not np.isnan(xs).all()
+
+    header = struct.pack("<4sIIII", MAGIC, n, m, len(group_names), FLAG_POSITIONS if has_positions else 0)
+    sections = [
+        header,
+        np.asarray(node_ids, dtype="<i4").tobytes(),
+        _pad(np.asarray(node_kinds, dtype="u1").tobytes()),
+        _pad(group_index.astype("u1").tobytes()),
+        np.asarray(xs, dtype="<f4").tobytes(),
+        np.asarray(ys, dtype="<f4").tobytes(),
+        *_string_table(titles),
+        *_string_table(list(group_names)),
+        np.asarray(edge_sources, dtype="<u4").tobytes(),
+        np.asarray(edge_targets, dtype="<u4").tobytes(),
+        _pad(np.asarray(edge_kinds, dtype="u1").tobytes()),
+    ]
+    return b"".join(sections)
+
+
+def _qualities(header: Optional[str]) -> Dict[str, float]:
+    """Maps each token of an Accept-style header to its q-value (1 when omitted, 0 when malformed)."""
+    qualities = {}
+    for part in (header or "").split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        qualities[name.lower()] = q
+    return qualities
+
+
+def accepts_binary(accept: Optional[str]) -> bool:
+    """Whether the Accept header asks for GRAPH_BINARY_MEDIA_TYPE at least as much as for JSON."""
+    qualities = _qualities(accept)
+    binary = qualities.get(GRAPH_BINARY_MEDIA_TYPE, 0.0)
+    json = qualities.get("application/json", qualities.get("application/*", qualities.get("*/*", 0.0)))
+    return binary > 0 and binary >= json
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Picks "br" or "gzip" from an Accept-Encoding header: the highest q-value
+    wins, brotli on ties, and q=0 (explicitly or via "*;q=0") rules one out.
+    """
+    qualities = _qualities(accept_encoding)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best, best_q = None, 0.0
+    for encoding in candidates:
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    return data
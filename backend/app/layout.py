@@ -0,0 +1,388 @@
+"""
+Server-side graph layout.
+
+Computes 2D positions for every graph node (notes and tags) with a vectorized
+Fruchterman-Reingold force simulation and persists them in `node_positions`,
+so `/api/graph` can ship ready-to-draw coordinates and the browser only has to
+fine-tune them.
+
+Repulsion is exact for small graphs. For large graphs nodes are binned into a
+hierarchy of uniform grids: repulsion from nodes in adjacent cells is exact,
+and cells further away act through their centre of mass, coarser the further
+away they are (Barnes-Hut).
+
+Note edits don't trigger a global layout. Writes whose links or tags changed
+record a "layout-dirty" change event; the leader worker collects these for
+RELAX_DEBOUNCE_S and then runs one `relax_nodes`, which moves only those notes
+and nodes that have no position yet, with everything else pinned.
+"""
+import asyncio
+import logging
+import math
+from typing import Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+
+from . import coordination
+from .database import AsyncSessionLocal
+from .models import Note, Link, Tag, NoteTag, NodePosition
+
+# Matches the frontend's default d3 link distance so positions need no rescaling
+LINK_DISTANCE = 50.0
+GRAVITY = 1.0
+
+# Above this many (moving nodes x all nodes) pairs, switch to grid approximation
+EXACT_PAIR_LIMIT = 1_000_000
+NODES_PER_CELL = 4  # Target occupancy of the finest grid level
+MAX_GRID_LEVELS = 9  # Finest grid is at most 512 x 512
+CHUNK_ROWS = 1024
+
+FULL_ITERATIONS = 150
+RELAX_ITERATIONS = 60
+RELAX_DEBOUNCE_S = 2.0
+
+NodeKey = Tuple[str, int]  # ("note", id) or ("tag", id)
+
+logger = logging.getLogger(__name__)
+
+# One layout job at a time per process; relaxations queue behind full layouts
+_layout_lock = asyncio.Lock()
+_dirty_nodes: Set[NodeKey] = set()
+_relax_requested = False
+_relax_task: Optional[asyncio.Task] = None
+
+
+# --- Force simulation (pure NumPy) ---
+
+def _exact_repulsion(pos: np.ndarray, rows: np.ndarray, k2: float) -> np.ndarray:
+    """k^2 / d repulsion on `rows` from every node, computed in chunks."""
+    out = np.empty((len(rows), 2))
+    for start in range(0, len(rows), CHUNK_ROWS):
+        idx = rows[start:start + CHUNK_ROWS]
+        dx = pos[idx, 0, None] - pos[None, :, 0]
+        dy = pos[idx, 1, None] - pos[None, :, 1]
+        inv = dx * dx + dy * dy
+        inv[inv == 0] = np.inf  # self and coincident nodes
+        np.reciprocal(inv, out=inv)
+        out[start:start + len(idx), 0] = (inv * dx).sum(axis=1)
+        out[start:start + len(idx), 1] = (inv * dy).sum(axis=1)
+    return k2 * out
+
+
+def _cell_stats(cell_xy: np.ndarray, pos: np.ndarray, g: int):
+    """Node count and centre of mass of every cell of a g x g grid."""
+    cell = cell_xy[:, 0] * g + cell_xy[:, 1]
+    counts = np.bincount(cell, minlength=g * g)
+    com = np.stack([
+        np.bincount(cell, weights=pos[:, 0], minlength=g * g),
+        np.bincount(cell, weights=pos[:, 1], minlength=g * g),
+    ], axis=1) / np.maximum(counts, 1)[:, None]
+    return cell, counts, com
+
+
+def _grid_repulsion(pos: np.ndarray, rows: np.ndarray, k2: float) -> np.ndarray:
+    """
+    Hierarchical grid approximation (a Barnes-Hut quadtree over uniform levels).
+
+    On the finest grid, nodes in a node's own and adjacent cells repel exactly.
+    Every other cell is visited once, at the coarsest level where it is still
+    at least one cell width away (the children of the parent's neighbours that
+    are not the node's own neighbours), and acts through its centre of mass.
+    """
+    n = len(pos)
+    levels = int(min(MAX_GRID_LEVELS, max(2, math.ceil(math.log(max(n / NODES_PER_CELL, 1), 4)))))
+    g = 2 ** levels
+    lo = pos.min(axis=0)
+    span = np.maximum(pos.max(axis=0) - lo, 1e-9)
+    fine_xy = np.minimum((g * (pos - lo) / span).astype(np.intp), g - 1)
+    stats = {
+        level: _cell_stats(fine_xy >> (levels - level), pos, 2 ** level)
+        for level in range(2, levels + 1)
+    }
+
+    # Nodes sorted by finest cell, so each cell's members are one contiguous slice
+    cell, counts, _ = stats[levels]
+    order = np.argsort(cell, kind="stable")
+    cell_start = np.cumsum(counts) - counts
+    far_offsets = np.array([(dx, dy) for dx in range(-2, 4) for dy in range(-2, 4)])
+    near_offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    out = np.empty((len(rows), 2))
+    for start in range(0, len(rows), CHUNK_ROWS):
+        idx = rows[start:start + CHUNK_ROWS]
+        p = pos[idx]
+        force = np.zeros((len(idx), 2))
+
+        # Far field: interaction list at every level
+        for level in range(2, levels + 1):
+            gl = 2 ** level
+            _, level_counts, level_com = stats[level]
+            cx, cy = (fine_xy[idx, 0] >> (levels - level)), (fine_xy[idx, 1] >> (levels - level))
+            nx = 2 * (cx[:, None] // 2) + far_offsets[None, :, 0]
+            ny = 2 * (cy[:, None] // 2) + far_offsets[None, :, 1]
+            valid = (nx >= 0) & (nx < gl) & (ny >= 0) & (ny < gl)
+            valid &= (np.abs(nx - cx[:, None]) > 1) | (np.abs(ny - cy[:, None]) > 1)
+            ncell = np.where(valid, nx * gl + ny, 0)
+            mass = np.where(valid, level_counts[ncell], 0)
+            dx = p[:, 0, None] - level_com[ncell, 0]
+            dy = p[:, 1, None] - level_com[ncell, 1]
+            weights = dx * dx + dy * dy
+            weights[mass == 0] = np.inf
+            np.divide(mass, weights, out=weights)
+            force[:, 0] += (weights * dx).sum(axis=1)
+            force[:, 1] += (weights * dy).sum(axis=1)
+
+        # Near field: exact pairs against every node in the adjacent finest cells
+        cx, cy = fine_xy[idx, 0], fine_xy[idx, 1]
+        local, first, length = [], [], []
+        for dx, dy in near_offsets:
+            nx, ny = cx + dx, cy + dy
+            valid = (nx >= 0) & (nx < g) & (ny >= 0) & (ny < g)
+            ncell = nx[valid] * g + ny[valid]
+            local.append(np.flatnonzero(valid))
+            first.append(cell_start[ncell])
+            length.append(counts[ncell])
+        local, first, length = np.concatenate(local), np.concatenate(first), np.concatenate(length)
+        pair_row = np.repeat(local, length)
+        # Expand each [first, first + length) range into consecutive positions of `order`
+        run_start = np.cumsum(length) - length
+        pair_node = order[np.repeat(first - run_start, length) + np.arange(length.sum())]
+
+        d = p[pair_row] - pos[pair_node]
+        inv = np.einsum("ij,ij->i", d, d)
+        inv[inv == 0] = np.inf  # self and coincident nodes
+        np.reciprocal(inv, out=inv)
+        force[:, 0] += np.bincount(pair_row, weights=inv * d[:, 0], minlength=len(idx))
+        force[:, 1] += np.bincount(pair_row, weights=inv * d[:, 1], minlength=len(idx))
+
+        out[start:start + len(idx)] = k2 * force
+    return out
+
+
+def force_layout(
+    num_nodes: int,
+    edges: np.ndarray,
+    positions: Optional[np.ndarray] = None,
+    movable: Optional[np.ndarray] = None,
+    iterations: int = FULL_ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Runs a Fruchterman-Reingold simulation and returns an (n, 2) array.
+
+    `edges` is an (m, 2) array of node indices. When `positions` is given it is
+    used as the starting layout; `movable` (indices) restricts which nodes may
+    move, all others are treated as pinned.
+    """
+    n = num_nodes
+    if n == 0:
+        return np.zeros((0, 2))
+
+    k = LINK_DISTANCE
+    k2 = k * k
+    rng = np.random.default_rng(seed)
+
+    if positions is None:
+        radius = k * math.sqrt(n)
+        angle = rng.uniform(0, 2 * math.pi, n)
+        r = radius * np.sqrt(rng.uniform(0, 1, n))
+        pos = np.column_stack([r * np.cos(angle), r * np.sin(angle)])
+    else:
+        pos = np.array(positions, dtype=float, copy=True)
+
+    rows = np.arange(n) if movable is None else np.asarray(movable, dtype=np.intp)
+    if len(rows) == 0:
+        return pos
+
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    src, dst = edges[:, 0], edges[:, 1]
+
+    # Full layouts start hot; relaxations only nudge nodes into place
+    t0 = k * math.sqrt(n) / 10 if movable is None else k
+    exact = len(rows) * n <= EXACT_PAIR_LIMIT
+
+    for step in range(iterations):
+        temperature = t0 * (1 - step / iterations) + 0.5
+
+        if exact:
+            disp = _exact_repulsion(pos, rows, k2)
+        else:
+            disp = _grid_repulsion(pos, rows, k2)
+
+        if len(edges):
+            delta = pos[src] - pos[dst]
+            dist = np.sqrt(np.einsum("ij,ij->i", delta, delta))
+            pull = delta * (dist / k)[:, None]
+            attraction = np.stack([
+                np.bincount(dst, weights=pull[:, 0], minlength=n) - np.bincount(src, weights=pull[:, 0], minlength=n),
+                np.bincount(dst, weights=pull[:, 1], minlength=n) - np.bincount(src, weights=pull[:, 1], minlength=n),
+            ], axis=1)
+            disp += attraction[rows]
+
+        disp -= GRAVITY * pos[rows]
+
+        length = np.sqrt(np.einsum("ij,ij->i", disp, disp))
+        length[length == 0] = 1.0
+        pos[rows] += disp * (np.minimum(length, temperature) / length)[:, None]
+
+    return pos
+
+
+# --- Persistence ---
+
+def _lookup(sorted_ids: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices of `values` in `sorted_ids`, plus a mask of the values that were found."""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(values), dtype=np.intp), np.zeros(len(values), dtype=bool)
+    idx = np.minimum(np.searchsorted(sorted_ids, values), len(sorted_ids) - 1)
+    return idx, sorted_ids[idx] == values
+
+
+async def _load_graph(db) -> Tuple[List[NodeKey], np.ndarray, np.ndarray]:
+    """
+    Loads node keys, index-based edges and stored positions (NaN where unplaced).
+    Notes come first, then tags, each sorted by id, so ids map to indices by binary search.
+    """
+    note_ids = np.array((await db.execute(select(Note.id).order_by(Note.id))).scalars().all(), dtype=np.int64)
+    tag_ids = np.array((await db.execute(select(Tag.id).order_by(Tag.id))).scalars().all(), dtype=np.int64)
+    keys: List[NodeKey] = [("note", i) for i in note_ids.tolist()] + [("tag", i) for i in tag_ids.tolist()]
+    offsets = {"note": (note_ids, 0), "tag": (tag_ids, len(note_ids))}
+
+    def endpoints(rows, a_type: str, b_type: str) -> np.ndarray:
+        pairs = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        (a_ids, a_off), (b_ids, b_off) = offsets[a_type], offsets[b_type]
+        a, a_found = _lookup(a_ids, pairs[:, 0])
+        b, b_found = _lookup(b_ids, pairs[:, 1])
+        found = a_found & b_found
+        return np.column_stack([a[found] + a_off, b[found] + b_off])
+
+    edges = np.concatenate([
+        endpoints((await db.execute(select(Link.source_note_id, Link.target_note_id))).all(), "note", "note"),
+        endpoints((await db.execute(select(NoteTag.note_id, NoteTag.tag_id))).all(), "note", "tag"),
+    ]).astype(np.intp)
+
+    stored = np.full((len(keys), 2), np.nan)
+    stmt = select(NodePosition.node_type, NodePosition.ref_id, NodePosition.x, NodePosition.y)
+    rows = (await db.execute(stmt)).all()
+    for node_type, (ids, off) in offsets.items():
+        typed = [(ref_id, x, y) for t, ref_id, x, y in rows if t == node_type]
+        if typed:
+            values = np.array(typed, dtype=float).reshape(-1, 3)
+            idx, found = _lookup(ids, values[:, 0].astype(np.int64))
+            stored[idx[found] + off] = values[found, 1:]
+    return keys, edges, stored
+
+
+async def _save_positions(db, keys: List[NodeKey], pos: np.ndarray, rows: Iterable[int], replace_all: bool = False):
+    rows = list(rows)
+    if replace_all:
+        await db.execute(delete(NodePosition))
+    else:
+        for node_type in ("note", "tag"):
+            ids = [keys[i][1] for i in rows if keys[i][0] == node_type]
+            if ids:
+                await db.execute(delete(NodePosition).where(
+                    NodePosition.node_type == node_type, NodePosition.ref_id.in_(ids)
+                ))
+    if rows:
+        await db.execute(insert(NodePosition), [
+            {"node_type": keys[i][0], "ref_id": keys[i][1], "x": float(pos[i, 0]), "y": float(pos[i, 1])}
+            for i in rows
+        ])
+    await coordination.record_change(db, "layout")
+    await db.commit()
+
+
+async def recompute_layout():
+    """Computes a fresh global layout and replaces all stored positions."""
+    async with _layout_lock:
+        async with AsyncSessionLocal() as db:
+            keys, edges, _ = await _load_graph(db)
+            pos = await asyncio.to_thread(force_layout, len(keys), edges)
+            await _save_positions(db, keys, pos, range(len(keys)), replace_all=True)
+
+
+async def relax_nodes(node_keys: Iterable[NodeKey] = ()):
+    """
+    Incrementally places `node_keys` plus any node without a stored position.
+
+    Unplaced nodes start at the centroid of their placed neighbours; only these
+    nodes move while the rest of the layout stays pinned.
+    """
+    async with _layout_lock:
+        async with AsyncSessionLocal() as db:
+            keys, edges, stored = await _load_graph(db)
+            if not keys:
+                return
+            index = {key: i for i, key in enumerate(keys)}
+            dirty = {index[key] for key in node_keys if key in index}
+            placed = ~np.isnan(stored[:, 0])
+            dirty.update(np.flatnonzero(~placed).tolist())
+            if not dirty:
+                return
+
+            pos = np.where(placed[:, None], stored, 0.0)
+
+            rng = np.random.default_rng(len(keys))
+            if placed.any():
+                # Seed unplaced nodes next to their placed neighbours
+                both = np.concatenate([edges, edges[:, ::-1]])
+                both = both[placed[both[:, 1]] & ~placed[both[:, 0]]]
+                sums = np.zeros((len(keys), 2))
+                np.add.at(sums, both[:, 0], pos[both[:, 1]])
+                degree = np.bincount(both[:, 0], minlength=len(keys))
+                unplaced = np.flatnonzero(~placed)
+                has_neighbour = degree[unplaced] > 0
+                centre = pos[placed].mean(axis=0)
+                spread = max(pos[placed].std(), LINK_DISTANCE)
+                pos[unplaced] = np.where(
+                    has_neighbour[:, None],
+                    sums[unplaced] / np.maximum(degree[unplaced], 1)[:, None],
+                    centre + rng.normal(0, spread, (len(unplaced), 2)),
+                )
+                pos[unplaced] += rng.normal(0, LINK_DISTANCE / 2, (len(unplaced), 2))
+                movable = np.array(sorted(dirty), dtype=np.intp)
+                pos = await asyncio.to_thread(
+                    force_layout, len(keys), edges, pos, movable, RELAX_ITERATIONS
+                )
+                await _save_positions(db, keys, pos, movable)
+            else:
+                pos = await asyncio.to_thread(force_layout, len(keys), edges)
+                await _save_positions(db, keys, pos, range(len(keys)), replace_all=True)
+
+
+async def ensure_layout():
+    """Startup hook: lays out the graph if it has never been laid out, or fills gaps."""
+    await relax_nodes()
+
+
+async def _relax_dirty():
+    global _relax_requested
+    # Keep going while edits arrive during a relaxation, so none are dropped
+    while _relax_requested:
+        await asyncio.sleep(RELAX_DEBOUNCE_S)
+        _relax_requested = False
+        node_keys = list(_dirty_nodes)
+        _dirty_nodes.clear()
+        try:
+            await relax_nodes(node_keys)
+        except Exception:
+            logger.exception("Layout relaxation failed")
+
+
+def _on_layout_dirty(topic: str, ref_id: Optional[int]):
+    """Batches "layout-dirty" events into one debounced relaxation, in the leader only."""
+    global _relax_task, _relax_requested
+    if not coordination.is_leader():
+        return
+    # ref_id None (missed events): relax_nodes still places every unplaced node
+    if ref_id is not None:
+        _dirty_nodes.add(("note", ref_id))
+    _relax_requested = True
+    if _relax_task is None or _relax_task.done():
+        _relax_task = asyncio.get_running_loop().create_task(_relax_dirty())
+
+
+coordination.subscribe("layout-dirty", _on_layout_dirty)
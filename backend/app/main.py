@@ -1,7 +1,8 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .database import engine, Base
+from .database import engine, Base, AsyncSessionLocal
 from .routers import graph, notes, attachments
+from . import layout, tag_stats, coordination, storage
 
 app = FastAPI(title="Corporate Obsidian API")
 
@@ -14,11 +15,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Singleton background jobs run only in the leader worker
+# Lay out the graph (or fill in unplaced nodes) without blocking startup
+coordination.on_leadership(layout.ensure_layout)
+# Shard legacy uploads, then reclaim orphaned attachment rows and files periodically
+coordination.on_leadership(storage.run_gc)
+
 # Create tables on startup (Dev only - use Alembic for Prod)
 @app.on_event("startup")
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # With several workers, the first one through the lock migrates; the rest find it done
+    async with coordination.startup_lock():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSessionLocal(info={"writer": True}) as db:
+            await tag_stats.ensure_tag_stats(db)
+    await coordination.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await coordination.stop()
 
 app.include_router(graph.router, prefix="/api", tags=["graph"])
 app.include_router(notes.router, prefix="/api", tags=["notes"])
@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, TIMESTAMP, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, TIMESTAMP, Boolean, Float
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -93,6 +93,21 @@ class NoteTag(Base):
     note_id = Column(Integer, ForeignKey("notes.id"), primary_key=True)
     tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
 
+class TagStat(Base):
+    __tablename__ = "tag_stats"
+
+    # Maintained incrementally by tag_stats.apply_note_tag_diff
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    note_count = Column(Integer, default=0, index=True)
+
+class TagCooccurrence(Base):
+    __tablename__ = "tag_cooccurrence"
+
+    # Each unordered pair is stored once, with tag_a_id < tag_b_id
+    tag_a_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    tag_b_id = Column(Integer, ForeignKey("tags.id"), primary_key=True, index=True)
+    note_count = Column(Integer, default=0)
+
 class Attachment(Base):
     __tablename__ = "attachments"
     
@@ -106,3 +121,26 @@ class Attachment(Base):
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
     
     note = relationship("Note", backref="attachments")
+
+class NodePosition(Base):
+    __tablename__ = "node_positions"
+
+    # Graph node identity: ("note", Note.id) or ("tag", Tag.id)
+    node_type = Column(String, primary_key=True)
+    ref_id = Column(Integer, primary_key=True)
+
+    x = Column(Float)
+    y = Column(Float)
+
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChangeEvent(Base):
+    __tablename__ = "change_log"
+    # AUTOINCREMENT: ids must never be reused after pruning, workers tail by id
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    topic = Column(String)  # "note", "layout", ...
+    ref_id = Column(Integer, nullable=True)
+
+    created_at = Column(TIMESTAMP, default=datetime.utcnow, index=True)
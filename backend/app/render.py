@@ -0,0 +1,332 @@
+"""
+Server-side Markdown rendering for notes.
+
+Rendering produces HTML where:
+- `[[Target]]` / `[[Target|Alias]]` become links, marked as existing or missing
+- `#tag` becomes a link to the tag-filtered note list
+- `![[Target]]` is replaced by the rendered target note (transclusion), with
+  cycle detection and a depth limit; the surrounding paragraph is split around
+  it, and inside other inline markup it degrades to a link
+
+All link and embed targets are resolved with one batched query per embed depth
+level, not one lookup per link.
+
+Results are cached per worker by note id + content hash. Each entry also records
+what it depends on: the ids of the notes it embeds (transitively, through nested
+embeds), the ids of the notes it links to (including links inside embedded
+content), and whether any target was missing. The change log then invalidates
+exactly the affected entries. Saving note X drops X and every note that embeds
+it; links only render the target's id, so notes linking to X are dropped only
+when X is deleted. Creating a note drops only the entries that had a missing
+target. Entries leave the reverse indexes when they leave the cache.
+"""
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+from urllib.parse import quote
+
+from markdown_it import MarkdownIt
+from markdown_it.common.utils import escapeHtml
+from slugify import slugify
+from sqlalchemy import select
+
+from . import coordination
+from .models import Note
+
+MAX_EMBED_DEPTH = 5
+RENDER_CACHE_SIZE = 2000
+
+WIKILINK_TARGETS = re.compile(r'\[\[([^\]|]+)(?:\|[^\]]+)?\]\]')
+EMBED_TARGETS = re.compile(r'!\[\[([^\]|]+)(?:\|[^\]]+)?\]\]')
+TAG_PATTERN = re.compile(r'#(\w+)')
+
+
+@dataclass
+class ResolvedNote:
+    id: int
+    title: str
+    content: str
+
+
+@dataclass
+class RenderContext:
+    """Per-request state shared by the markdown-it rules (`env["render"]`)."""
+    notes_by_slug: Dict[str, ResolvedNote]
+    stack: List[int]
+    link_dependencies: Set[int] = field(default_factory=set)
+    embed_dependencies: Set[int] = field(default_factory=set)
+    has_missing: bool = False
+
+
+def content_hash(content: Optional[str]) -> str:
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+
+# --- markdown-it extensions ---
+
+def _wikilink_rule(state, silent: bool) -> bool:
+    src, pos = state.src, state.pos
+    embed = src.startswith("![[", pos)
+    if not embed and not src.startswith("[[", pos):
+        return False
+    start = pos + (3 if embed else 2)
+    end = src.find("]]", start)
+    if end < 0:
+        return False
+    inner = src[start:end]
+    if not inner.strip() or "[" in inner or "\n" in inner:
+        return False
+    if not silent:
+        target, _, alias = inner.partition("|")
+        token = state.push("embed" if embed else "wikilink", "", 0)
+        token.meta = {"target": target.strip(), "alias": alias.strip() or None}
+    state.pos = end + 2
+    return True
+
+
+def _tag_rule(state, silent: bool) -> bool:
+    src, pos = state.src, state.pos
+    if src[pos] != "#" or (pos > 0 and not (src[pos - 1].isspace() or src[pos - 1] in "([")):
+        return False
+    match = TAG_PATTERN.match(src, pos)
+    if not match:
+        return False
+    if not silent:
+        token = state.push("tag", "", 0)
+        token.meta = {"name": match.group(1)}
+    state.pos = match.end()
+    return True
+
+
+def _is_blank(token) -> bool:
+    return token.type in ("softbreak", "hardbreak") or (token.type == "text" and not token.content.strip())
+
+
+def _split_block_embeds(state):
+    """
+    Lifts `![[...]]` out of paragraphs so the embedded note renders as a block:
+    "a ![[X]] b" becomes <p>a</p><div class="transclusion">...</div><p>b</p>.
+    Embeds nested in other inline markup (emphasis, links, headings, tables)
+    can't be lifted and render as an inline link instead.
+    """
+    tokens, out = state.tokens, []
+    i = 0
+    while i < len(tokens):
+        if not (
+            tokens[i].type == "paragraph_open" and i + 2 < len(tokens)
+            and any(c.type == "embed" and c.level == 0 for c in tokens[i + 1].children or [])
+        ):
+            out.append(tokens[i])
+            i += 1
+            continue
+
+        paragraph_open, inline, paragraph_close = tokens[i:i + 3]
+        segment = []
+
+        def flush():
+            while segment and _is_blank(segment[0]):
+                segment.pop(0)
+            while segment and _is_blank(segment[-1]):
+                segment.pop()
+            if segment:
+                if segment[0].type == "text":
+                    segment[0].content = segment[0].content.lstrip()
+                if segment[-1].type == "text":
+                    segment[-1].content = segment[-1].content.rstrip()
+                out.extend([paragraph_open.copy(), inline.copy(children=list(segment)), paragraph_close.copy()])
+            segment.clear()
+
+        for child in inline.children:
+            if child.type == "embed" and child.level == 0:
+                flush()
+                child.meta["block"] = True
+                out.append(inline.copy(children=[child]))
+            else:
+                segment.append(child)
+        flush()
+        i += 3
+    state.tokens = out
+
+
+def _render_wikilink(self, tokens, idx, options, env) -> str:
+    target, alias = tokens[idx].meta["target"], tokens[idx].meta["alias"]
+    context: RenderContext = env["render"]
+    label = escapeHtml(alias or target)
+    note = context.notes_by_slug.get(slugify(target))
+    if note is None:
+        context.has_missing = True
+        return (f'<a class="wikilink wikilink-missing" data-target="{escapeHtml(target)}" '
+                f'href="/notes/new?title={quote(target)}">{label}</a>')
+    context.link_dependencies.add(note.id)
+    return f'<a class="wikilink" data-note-id="{note.id}" href="/notes/{note.id}">{label}</a>'
+
+
+def _render_tag(self, tokens, idx, options, env) -> str:
+    name = tokens[idx].meta["name"]
+    return f'<a class="tag" data-tag="{escapeHtml(name)}" href="/notes?search={quote("#" + name)}">#{escapeHtml(name)}</a>'
+
+
+def _render_embed(self, tokens, idx, options, env) -> str:
+    target = tokens[idx].meta["target"]
+    context: RenderContext = env["render"]
+    note = context.notes_by_slug.get(slugify(target))
+    block = tokens[idx].meta.get("block", False)
+    if note is None:
+        context.has_missing = True
+        tag, end = ("div", "\n") if block else ("span", "")
+        return (f'<{tag} class="transclusion transclusion-missing" data-target="{escapeHtml(target)}">'
+                f'<a href="/notes/new?title={quote(target)}">{escapeHtml(target)}</a></{tag}>{end}')
+
+    context.embed_dependencies.add(note.id)
+    if not block:
+        return (f'<span class="transclusion transclusion-inline" data-note-id="{note.id}">'
+                f'<a href="/notes/{note.id}">{escapeHtml(note.title)}</a></span>')
+    header = f'<div class="transclusion-title"><a href="/notes/{note.id}">{escapeHtml(note.title)}</a></div>'
+    if note.id in context.stack:
+        return f'<div class="transclusion transclusion-cycle" data-note-id="{note.id}">{header}</div>\n'
+    if len(context.stack) > MAX_EMBED_DEPTH:
+        return f'<div class="transclusion transclusion-depth" data-note-id="{note.id}">{header}</div>\n'
+
+    context.stack.append(note.id)
+    try:
+        body = md.render(note.content or "", {"render": context})  # Fresh env: no shared reference defs
+    finally:
+        context.stack.pop()
+    return f'<div class="transclusion" data-note-id="{note.id}">{header}{body}</div>\n'
+
+
+md = MarkdownIt("commonmark", {"html": False}).enable(["table", "strikethrough"])
+md.inline.ruler.before("link", "wikilink", _wikilink_rule)
+md.inline.ruler.before("link", "tag", _tag_rule)
+md.core.ruler.push("split_block_embeds", _split_block_embeds)
+md.add_render_rule("wikilink", _render_wikilink)
+md.add_render_rule("tag", _render_tag)
+md.add_render_rule("embed", _render_embed)
+
+
+# --- Cache ---
+
+class RenderCache:
+    """
+    LRU of rendered HTML keyed by note id, validated against the content hash.
+    Invalidated through the change log (see module docstring).
+    """
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # note_id -> (content_hash, html, link deps, embed deps)
+        self._link_dependents: Dict[int, Set[int]] = {}  # linked note id -> cached note ids
+        self._embed_dependents: Dict[int, Set[int]] = {}  # embedded note id -> cached note ids
+        self._missing_dependents: Set[int] = set()
+
+    def get(self, note_id: int, digest: str) -> Optional[str]:
+        entry = self._entries.get(note_id)
+        if entry is None or entry[0] != digest:
+            return None
+        self._entries.move_to_end(note_id)
+        return entry[1]
+
+    def put(self, note_id: int, digest: str, html: str, context: RenderContext, version: int):
+        if version != self.version:
+            return  # Something changed while rendering
+        self._remove(note_id)
+        self._entries[note_id] = (digest, html, context.link_dependencies, context.embed_dependencies)
+        for dep in context.link_dependencies:
+            self._link_dependents.setdefault(dep, set()).add(note_id)
+        for dep in context.embed_dependencies:
+            self._embed_dependents.setdefault(dep, set()).add(note_id)
+        if context.has_missing:
+            self._missing_dependents.add(note_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, note_id: int):
+        """Drops one entry and its reverse-index references."""
+        entry = self._entries.pop(note_id, None)
+        if entry is None:
+            return
+        for index, deps in ((self._link_dependents, entry[2]), (self._embed_dependents, entry[3])):
+            for dep in deps:
+                dependents = index.get(dep)
+                if dependents is not None:
+                    dependents.discard(note_id)
+                    if not dependents:
+                        del index[dep]
+        self._missing_dependents.discard(note_id)
+
+    def _drop(self, note_ids: Set[int]):
+        self.version += 1
+        for note_id in note_ids:
+            self._remove(note_id)
+
+    def invalidate_note(self, topic: str, ref_id: Optional[int]):
+        """Note saved: its own entry and every entry that embeds it."""
+        if ref_id is None:
+            self.clear()
+            return
+        self._drop({ref_id} | self._embed_dependents.get(ref_id, set()))
+
+    def invalidate_deleted(self, topic: str, ref_id: Optional[int]):
+        """Note deleted: links to it now render as missing, too."""
+        if ref_id is None:
+            self.clear()
+            return
+        self._drop({ref_id} | self._embed_dependents.get(ref_id, set()) | self._link_dependents.get(ref_id, set()))
+
+    def invalidate_missing(self, topic: str, ref_id: Optional[int]):
+        self._drop(set(self._missing_dependents))
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self._link_dependents.clear()
+        self._embed_dependents.clear()
+        self._missing_dependents.clear()
+
+
+render_cache = RenderCache()
+coordination.subscribe("note", render_cache.invalidate_note)
+coordination.subscribe("note-deleted", render_cache.invalidate_deleted)
+coordination.subscribe("note-created", render_cache.invalidate_missing)
+
+
+# --- Rendering ---
+
+async def _resolve_targets(db, content: str) -> Dict[str, ResolvedNote]:
+    """
+    Loads every link/embed target reachable through embeds, one query per depth level.
+    Only embedded notes need their content scanned further.
+    """
+    notes_by_slug: Dict[str, ResolvedNote] = {}
+    seen: Set[str] = set()
+    pending = [content]
+    for _ in range(MAX_EMBED_DEPTH + 1):
+        link_slugs, embed_slugs = set(), set()
+        for text in pending:
+            link_slugs.update(slugify(t) for t in WIKILINK_TARGETS.findall(text))
+            embed_slugs.update(slugify(t) for t in EMBED_TARGETS.findall(text))
+        wanted = (link_slugs | embed_slugs) - seen
+        if not wanted:
+            break
+        seen |= wanted
+        stmt = select(Note.id, Note.slug, Note.title, Note.content).where(Note.slug.in_(wanted))
+        for note_id, slug, title, note_content in await db.execute(stmt):
+            notes_by_slug[slug] = ResolvedNote(note_id, title, note_content or "")
+        pending = [notes_by_slug[s].content for s in embed_slugs if s in notes_by_slug]
+    return notes_by_slug
+
+
+async def render_note(db, note_id: int, content: Optional[str]) -> str:
+    """Returns the note's HTML, from cache when its content and dependencies are unchanged."""
+    digest = content_hash(content)
+    cached = render_cache.get(note_id, digest)
+    if cached is not None:
+        return cached
+
+    version = render_cache.version
+    context = RenderContext(notes_by_slug=await _resolve_targets(db, content or ""), stack=[note_id])
+    html = md.render(content or "", {"render": context})
+    render_cache.put(note_id, digest, html, context, version)
+    return html
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import uuid
 from typing import List
@@ -6,14 +7,15 @@ from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 
-from ..database import get_db
-from ..models import Attachment
+from ..database import get_db, get_write_db
+from ..models import Attachment, Note
+from ..schemas import AttachmentUsage
+from .. import storage
 
 router = APIRouter()
 
-# Configure upload directory
-UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Files live in hashed subdirectories of storage.UPLOAD_DIR (see storage.py)
+os.makedirs(storage.UPLOAD_DIR, exist_ok=True)
 
 # Allowed file types
 ALLOWED_TYPES = {
@@ -31,7 +33,7 @@ MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 async def upload_attachment(
     file: UploadFile = File(...),
     note_id: int = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_write_db)
 ):
     """
     Upload a file (image or PDF) and return its URL.
@@ -50,13 +52,11 @@ async def upload_attachment(
     # 4. Generate unique filename
     ext = ALLOWED_TYPES[file.content_type]
     unique_filename = f"{uuid.uuid4()}{ext}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
     
     # 5. Save file
-    with open(file_path, "wb") as f:
-        f.write(content)
+    await asyncio.to_thread(storage.write_file, unique_filename, content)
     
-    # 6. Create database record
+    # 6. Create database record (and drop the file again if that fails)
     attachment = Attachment(
         filename=unique_filename,
         original_name=file.filename,
@@ -64,8 +64,12 @@ async def upload_attachment(
         size_bytes=len(content),
         note_id=note_id
     )
-    db.add(attachment)
-    await db.commit()
+    try:
+        db.add(attachment)
+        await db.commit()
+    except BaseException:
+        storage.remove_files([unique_filename])
+        raise
     await db.refresh(attachment)
     
     # 7. Return info
@@ -93,7 +97,7 @@ async def get_attachment(filename: str, db: Session = Depends(get_db)):
         raise HTTPException(404, "Attachment not found")
     
     # 2. Build path
-    file_path = os.path.join(UPLOAD_DIR, filename)
+    file_path = storage.resolve_path(filename)
     
     if not os.path.exists(file_path):
         raise HTTPException(404, "File not found on disk")
@@ -107,7 +111,7 @@ async def get_attachment(filename: str, db: Session = Depends(get_db)):
 
 
 @router.delete("/attachments/{attachment_id}")
-async def delete_attachment(attachment_id: int, db: Session = Depends(get_db)):
+async def delete_attachment(attachment_id: int, db: Session = Depends(get_write_db)):
     """
     Delete an attachment.
     """
@@ -118,13 +122,37 @@ async def delete_attachment(attachment_id: int, db: Session = Depends(get_db)):
     if not attachment:
         raise HTTPException(404, "Attachment not found")
     
-    # Delete file from disk
-    file_path = os.path.join(UPLOAD_DIR, attachment.filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    
-    # Delete from DB
+    # Delete from DB first: if the commit fails the file is still there
+    filename = attachment.filename
     await db.delete(attachment)
     await db.commit()
     
+    # Delete file from disk
+    storage.remove_files([filename])
+    
     return {"message": "Attachment deleted successfully"}
+
+
+@router.get("/storage/usage", response_model=List[AttachmentUsage])
+async def get_storage_usage(limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Attachment storage per note, largest first.
+    Attachments not referenced by any note are reported under note_id null.
+    """
+    rows = await storage.note_usage(db, limit=limit)
+    return [
+        {"note_id": note_id, "attachment_count": count, "total_bytes": total}
+        for note_id, count, total in rows
+    ]
+
+
+@router.get("/notes/{note_id}/attachments/usage", response_model=AttachmentUsage)
+async def get_note_storage_usage(note_id: int, db: Session = Depends(get_db)):
+    """
+    Attachment storage used by one note.
+    """
+    if not (await db.execute(select(Note.id).where(Note.id == note_id))).scalar_one_or_none():
+        raise HTTPException(404, "Note not found")
+    rows = await storage.note_usage(db, note_ids=[note_id])
+    count, total = (rows[0][1], rows[0][2]) if rows else (0, 0)
+    return {"note_id": note_id, "attachment_count": count, "total_bytes": total}
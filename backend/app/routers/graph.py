@@ -1,74 +1,191 @@
-from fastapi import APIRouter, Depends
+import asyncio
+from itertools import chain
+
+import numpy as np
+from fastapi import APIRouter, Depends, BackgroundTasks, Request
+from fastapi.responses import Response
+from sqlalchemy import func, literal
 from sqlalchemy.orm import Session
 from sqlalchemy.future import select
 
 from ..database import get_db
-from ..models import Note, Link, Tag, NoteTag
+from ..models import Note, Link, Tag, NoteTag, NodePosition
+from ..serializers import MsgspecJSONResponse, GraphOut, GraphNodeOut, GraphLinkOut
+from .. import layout, coordination, graph_codec
 
 router = APIRouter()
 
-@router.get("/graph")
-async def get_graph(db: Session = Depends(get_db)):
+# Encoded graph payloads; dropped in every worker when notes or positions change
+graph_cache = coordination.LocalCache("note", "layout")
+
+# Both representations are negotiated on the same URL
+NEGOTIATION_HEADERS = {"Vary": "Accept, Accept-Encoding"}
+
+@router.get("/graph", response_model=None)
+async def get_graph(request: Request, db: Session = Depends(get_db)):
     """
     Retrieves the entire knowledge graph.
-    Optimized to return lightweight JSON.
+    Optimized to return lightweight JSON: rows are packed straight into msgspec Structs.
     Includes tags as separate nodes with note-tag relationships.
+    Nodes carry precomputed "x"/"y" positions once the server has laid them out.
+    The encoded payload is cached per worker until the change log reports an edit.
+
+    Clients sending `Accept: application/vnd.corporate-obsidian.graph+binary` get the
+    columnar encoding from graph_codec instead (gzip/brotli compressed on request);
+    q-values are honoured for both headers.
     """
+    if graph_codec.accepts_binary(request.headers.get("accept")):
+        return await get_graph_binary(request.headers.get("accept-encoding"), db)
+    return await get_graph_json(db)
+
+async def get_graph_json(db: Session) -> Response:
+    cached = graph_cache.get("json")
+    if cached is not None:
+        return Response(cached, media_type="application/json", headers=NEGOTIATION_HEADERS)
+    version = graph_cache.version
     
+    # 0. Fetch precomputed layout positions
+    stmt_positions = select(NodePosition.node_type, NodePosition.ref_id, NodePosition.x, NodePosition.y)
+    positions = {
+        (node_type, ref_id): (x, y)
+        for node_type, ref_id, x, y in await db.execute(stmt_positions)
+    }
+    no_position = (None, None)
+
     # 1. Fetch all Note Nodes
     stmt_nodes = select(Note.id, Note.title, Note.visibility)
-    result_nodes = await db.execute(stmt_nodes)
-    
-    nodes_data = []
-    for row in result_nodes:
-        nodes_data.append({
-            "id": row.id,
-            "title": row.title,
-            "group": row.visibility or "public",  # Color by visibility
-            "type": "note"
-        })
+    nodes_data = [
+        # Color by visibility
+        GraphNodeOut(note_id, title, visibility or "public", "note", *positions.get(("note", note_id), no_position))
+        for note_id, title, visibility in await db.execute(stmt_nodes)
+    ]
 
     # 2. Fetch all Note-to-Note Links
     stmt_links = select(Link.source_note_id, Link.target_note_id)
-    result_links = await db.execute(stmt_links)
-    
-    links_data = []
-    for row in result_links:
-        links_data.append({
-            "source": row.source_note_id,
-            "target": row.target_note_id,
-            "type": "note-link"
-        })
+    links_data = [
+        GraphLinkOut(source, target, "note-link")
+        for source, target in await db.execute(stmt_links)
+    ]
 
     # 3. Fetch all Tags as nodes
+    # Use string IDs for tags to avoid collision with note IDs
     stmt_tags = select(Tag.id, Tag.name)
-    result_tags = await db.execute(stmt_tags)
-    
-    tags_data = []
-    for row in result_tags:
-        # Use string IDs for tags to avoid collision with note IDs
-        tags_data.append({
-            "id": f"tag-{row.id}",
-            "title": f"#{row.name}",
-            "group": "tag",
-            "type": "tag"
-        })
+    tags_data = [
+        GraphNodeOut(f"tag-{tag_id}", f"#{name}", "tag", "tag", *positions.get(("tag", tag_id), no_position))
+        for tag_id, name in await db.execute(stmt_tags)
+    ]
 
     # 4. Fetch all Note-Tag relationships
     stmt_note_tags = select(NoteTag.note_id, NoteTag.tag_id)
-    result_note_tags = await db.execute(stmt_note_tags)
-    
-    tag_links_data = []
-    for row in result_note_tags:
-        tag_links_data.append({
-            "source": row.note_id,
-            "target": f"tag-{row.tag_id}",
-            "type": "tag-link"
-        })
-
-    return {
-        "nodes": nodes_data,
-        "links": links_data,
-        "tags": tags_data,
-        "tagLinks": tag_links_data
+    tag_links_data = [
+        GraphLinkOut(note_id, f"tag-{tag_id}", "tag-link")
+        for note_id, tag_id in await db.execute(stmt_note_tags)
+    ]
+
+    response = MsgspecJSONResponse(GraphOut(nodes_data, links_data, tags_data, tag_links_data), headers=NEGOTIATION_HEADERS)
+    graph_cache.put("json", response.body, version)
+    return response
+
+async def get_graph_binary(accept_encoding: str, db: Session) -> Response:
+    encoding = graph_codec.negotiate_encoding(accept_encoding)
+    headers = dict(NEGOTIATION_HEADERS)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    cache_key = f"binary:{encoding}"
+    cached = graph_cache.get(cache_key)
+    if cached is None:
+        version = graph_cache.version
+        # Compressing a large graph takes long enough to stall every other request
+        cached = await asyncio.to_thread(graph_codec.compress, await build_graph_binary(db), encoding)
+        graph_cache.put(cache_key, cached, version)
+    return Response(cached, media_type=graph_codec.GRAPH_BINARY_MEDIA_TYPE, headers=headers)
+
+def _int_columns(rows, width: int) -> np.ndarray:
+    """Flattens integer row tuples into an (n, width) array without a Python loop per row."""
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, width)
+
+def _lookup(sorted_ids: np.ndarray, ids: np.ndarray):
+    """Positions of `ids` in `sorted_ids` plus a mask of the ones that exist."""
+    idx = np.searchsorted(sorted_ids, ids)
+    idx_clipped = np.minimum(idx, max(len(sorted_ids) - 1, 0))
+    found = (idx < len(sorted_ids)) & (sorted_ids[idx_clipped] == ids) if len(sorted_ids) else np.zeros(len(ids), bool)
+    return idx_clipped, found
+
+async def build_graph_binary(db: Session) -> bytes:
+    """
+    Columnar graph: notes first (sorted by id), then tags (sorted by id).
+    Edges reference nodes by index into those columns.
+    Rows are read here; the NumPy work runs in a thread, off the event loop.
+    """
+    # Core connection: skips the ORM result-loading layer for these bulk column reads
+    conn = await db.connection()
+
+    # Titles and groups resolved in SQL
+    stmt_notes = select(Note.id, func.coalesce(Note.title, ""), func.coalesce(Note.visibility, "public")).order_by(Note.id)
+    notes = (await conn.execute(stmt_notes)).all()
+    stmt_tags = select(Tag.id, literal("#").concat(Tag.name)).order_by(Tag.id)
+    tags = (await conn.execute(stmt_tags)).all()
+    positions = {
+        node_type: (await conn.execute(
+            select(NodePosition.ref_id, NodePosition.x, NodePosition.y).where(NodePosition.node_type == node_type)
+        )).all()
+        for node_type in ("note", "tag")
     }
+    links = (await conn.execute(select(Link.source_note_id, Link.target_note_id))).all()
+    note_tags = (await conn.execute(select(NoteTag.note_id, NoteTag.tag_id))).all()
+    return await asyncio.to_thread(_encode_graph_rows, notes, tags, positions, links, note_tags)
+
+def _encode_graph_rows(notes, tags, positions, links, note_tags) -> bytes:
+    # 1. Node columns
+    note_ids, note_titles, note_groups = map(list, zip(*notes)) if notes else ([], [], [])
+    tag_ids, tag_titles = map(list, zip(*tags)) if tags else ([], [])
+
+    note_ids = np.array(note_ids, dtype=np.int64)
+    tag_ids = np.array(tag_ids, dtype=np.int64)
+    n_notes, n_tags = len(note_ids), len(tag_ids)
+    kinds = np.repeat(np.array([graph_codec.NODE_NOTE, graph_codec.NODE_TAG], dtype=np.uint8), [n_notes, n_tags])
+
+    # 2. Positions (NaN where the layout hasn't placed a node yet)
+    xs = np.full(n_notes + n_tags, np.nan)
+    ys = np.full(n_notes + n_tags, np.nan)
+    for node_type, ids, offset in (("note", note_ids, 0), ("tag", tag_ids, n_notes)):
+        rows = np.array(positions[node_type], dtype=np.float64).reshape(-1, 3)
+        idx, found = _lookup(ids, rows[:, 0].astype(np.int64))
+        xs[offset + idx[found]] = rows[found, 1]
+        ys[offset + idx[found]] = rows[found, 2]
+
+    # 3. Edges as node indices
+    links = _int_columns(links, 2)
+    src, src_found = _lookup(note_ids, links[:, 0])
+    dst, dst_found = _lookup(note_ids, links[:, 1])
+    keep = src_found & dst_found
+    link_src, link_dst = src[keep], dst[keep]
+
+    note_tags = _int_columns(note_tags, 2)
+    src, src_found = _lookup(note_ids, note_tags[:, 0])
+    dst, dst_found = _lookup(tag_ids, note_tags[:, 1])
+    keep = src_found & dst_found
+    tag_src, tag_dst = src[keep], n_notes + dst[keep]
+
+    edge_kinds = np.repeat(np.array([graph_codec.EDGE_NOTE_LINK, graph_codec.EDGE_TAG_LINK], dtype=np.uint8),
+                           [len(link_src), len(tag_src)])
+    return graph_codec.encode_graph(
+        np.concatenate([note_ids, tag_ids]),
+        kinds,
+        note_titles + tag_titles,
+        note_groups + ["tag"] * n_tags,
+        xs, ys,
+        np.concatenate([link_src, tag_src]),
+        np.concatenate([link_dst, tag_dst]),
+        edge_kinds,
+    )
+
+@router.post("/graph/layout")
+async def recompute_graph_layout(background_tasks: BackgroundTasks):
+    """
+    Schedules a full server-side layout of the graph.
+    Incremental relaxation after note edits happens automatically.
+    """
+    background_tasks.add_task(layout.recompute_layout)
+    return {"message": "Layout recomputation scheduled"}
@@ -2,12 +2,14 @@ import re
 from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session, selectinload
-from sqlalchemy import select, update
+from sqlalchemy import select, update, delete, case
 from slugify import slugify
 
-from ..database import get_db
-from ..models import Note, Link, Tag, NoteTag
-from ..schemas import NoteCreate, NoteRead, NoteUpdate, BacklinkResponse, TagRead
+from ..database import get_db, get_write_db
+from ..models import Note, Link, Tag, NoteTag, NodePosition, TagStat, TagCooccurrence, Attachment
+from ..schemas import NoteCreate, NoteRead, NoteUpdate, BacklinkResponse, TagRead, TagCount, RenderedNote
+from ..serializers import MsgspecJSONResponse, NoteOut, TagOut, TagCountOut, BacklinkOut
+from .. import tag_stats, coordination, render, storage
 
 router = APIRouter()
 
@@ -26,9 +28,37 @@ def extract_snippet(full_text: str, target_title: str, context_chars: int = 60)
 
 # --- CRUD Operations ---
 
+# Core-level columns for list endpoints (no ORM identity map, no pydantic validation)
+NOTE_LIST_COLUMNS = (
+    Note.title, Note.content, Note.visibility, Note.id, Note.slug,
+    Note.updated_at, Note.owner_id, Note.is_favorite,
+)
+
+async def fetch_note_list(stmt, db: Session) -> List[NoteOut]:
+    """
+    Runs a select over NOTE_LIST_COLUMNS and attaches tags with one extra query.
+    """
+    rows = (await db.execute(stmt)).all()
+    if not rows:
+        return []
+
+    note_ids = stmt.with_only_columns(Note.id).subquery()
+    stmt_tags = select(NoteTag.note_id, Tag.id, Tag.name)\
+        .join(Tag, Tag.id == NoteTag.tag_id)\
+        .where(NoteTag.note_id.in_(select(note_ids.c.id)))
+    tags_by_note = {}
+    for note_id, tag_id, tag_name in await db.execute(stmt_tags):
+        tags_by_note.setdefault(note_id, []).append(TagOut(tag_id, tag_name))
+
+    return [
+        NoteOut(title, content, visibility, note_id, slug, updated_at, owner_id,
+                bool(is_favorite), tags_by_note.get(note_id, []))
+        for title, content, visibility, note_id, slug, updated_at, owner_id, is_favorite in rows
+    ]
+
 @router.get("/notes", response_model=List[NoteRead])
 async def get_notes(search: Optional[str] = None, is_favorite: Optional[bool] = None, limit: int = 100, db: Session = Depends(get_db)):
-    stmt = select(Note).options(selectinload(Note.tags)).order_by(Note.updated_at.desc()).limit(limit)
+    stmt = select(*NOTE_LIST_COLUMNS).order_by(Note.updated_at.desc()).limit(limit)
     if search:
         if search.startswith('#'):
              # Search by Tag
@@ -39,8 +69,7 @@ async def get_notes(search: Optional[str] = None, is_favorite: Optional[bool] =
              stmt = stmt.where(Note.title.ilike(f"%{search}%"))
     if is_favorite is not None:
         stmt = stmt.where(Note.is_favorite == is_favorite)
-    result = await db.execute(stmt)
-    return result.scalars().all()
+    return MsgspecJSONResponse(await fetch_note_list(stmt, db))
 
 @router.get("/notes/search", response_model=List[NoteRead])
 async def search_notes(q: str, db: Session = Depends(get_db)):
@@ -51,7 +80,7 @@ async def search_notes(q: str, db: Session = Depends(get_db)):
     return await get_notes(search=q, db=db)
 
 @router.post("/notes", response_model=NoteRead)
-async def create_note(note: NoteCreate, db: Session = Depends(get_db)):
+async def create_note(note: NoteCreate, db: Session = Depends(get_write_db)):
     # 1. Generate Slug
     slug = slugify(note.title)
     
@@ -77,6 +106,13 @@ async def create_note(note: NoteCreate, db: Session = Depends(get_db)):
     # 4. Parse Links and Tags
     await update_graph_links(new_note, db)
     await update_tags(new_note, db)
+    await storage.claim_attachments(db, new_note)
+    await coordination.record_change(db, "note", new_note.id)
+    await coordination.record_change(db, "note-created", new_note.id)
+    
+    # 5. Have the leader place the new node in the precomputed layout
+    await coordination.record_change(db, "layout-dirty", new_note.id)
+    await db.commit()
     
     # Reload to get tags
     stmt = select(Note).options(selectinload(Note.tags)).where(Note.id == new_note.id)
@@ -91,8 +127,17 @@ async def get_note(note_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Note not found")
     return note
 
+@router.get("/notes/{note_id}/render", response_model=RenderedNote)
+async def render_note(note_id: int, db: Session = Depends(get_db)):
+    stmt = select(Note.content).where(Note.id == note_id)
+    row = (await db.execute(stmt)).one_or_none()
+    if not row:
+        raise HTTPException(status_code=404, detail="Note not found")
+    html = await render.render_note(db, note_id, row.content)
+    return {"id": note_id, "html": html, "content_hash": render.content_hash(row.content)}
+
 @router.put("/notes/{note_id}", response_model=NoteRead)
-async def update_note(note_id: int, update_data: NoteUpdate, db: Session = Depends(get_db)):
+async def update_note(note_id: int, update_data: NoteUpdate, db: Session = Depends(get_write_db)):
     stmt = select(Note).where(Note.id == note_id)
     result = await db.execute(stmt)
     note = result.scalar_one_or_none()
@@ -122,8 +167,13 @@ async def update_note(note_id: int, update_data: NoteUpdate, db: Session = Depen
         note.content = update_data.content
         db.add(note) # Explicitly add to session to ensure dirty tracking
         
-        await update_graph_links(note, db)
-        await update_tags(note, db)
+        links_changed = await update_graph_links(note, db)
+        tags_changed = await update_tags(note, db)
+        await storage.claim_attachments(db, note)
+        
+        # Edges changed: have the leader re-relax this node in the layout
+        if links_changed or tags_changed:
+            await coordination.record_change(db, "layout-dirty", note.id)
         
     if update_data.visibility is not None:
         note.visibility = update_data.visibility
@@ -131,6 +181,7 @@ async def update_note(note_id: int, update_data: NoteUpdate, db: Session = Depen
     if update_data.is_favorite is not None:
         note.is_favorite = update_data.is_favorite
         
+    await coordination.record_change(db, "note", note.id)
     await db.commit()
     await db.refresh(note)
     print(f"DEBUG: Saved note {note.id}. Content after refresh: {note.content[:20]}...")
@@ -156,7 +207,7 @@ async def get_note_revisions(note_id: int, db: Session = Depends(get_db)):
     return result.scalars().all()
 
 @router.delete("/revisions/{revision_id}")
-async def delete_revision(revision_id: int, db: Session = Depends(get_db)):
+async def delete_revision(revision_id: int, db: Session = Depends(get_write_db)):
     from ..models import Revision
     from sqlalchemy import delete
     
@@ -172,7 +223,7 @@ async def delete_revision(revision_id: int, db: Session = Depends(get_db)):
     return {"message": "Revision deleted successfully"}
 
 @router.delete("/notes/{note_id}")
-async def delete_note(note_id: int, db: Session = Depends(get_db)):
+async def delete_note(note_id: int, db: Session = Depends(get_write_db)):
     # 1. Check existence
     stmt = select(Note).where(Note.id == note_id)
     result = await db.execute(stmt)
@@ -180,8 +231,19 @@ async def delete_note(note_id: int, db: Session = Depends(get_db)):
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
         
-    # 2. Delete
+    # 2. Release its tags (updates aggregates, drops tags left without notes)
+    old_tag_ids = await tag_stats.note_tag_ids(db, note_id)
+    await tag_stats.apply_note_tag_diff(db, note_id, old_tag_ids, set())
+
+    # 3. Release its attachments; the upload GC hands shared ones to another note
+    # that embeds them and deletes the rest (see storage.py)
+    await db.execute(update(Attachment).where(Attachment.note_id == note_id).values(note_id=None))
+
+    # 4. Delete
+    await db.execute(delete(NodePosition).where(NodePosition.node_type == "note", NodePosition.ref_id == note_id))
     await db.delete(note)
+    await coordination.record_change(db, "note", note_id)
+    await coordination.record_change(db, "note-deleted", note_id)
     await db.commit()
     return {"message": "Note deleted successfully"}
 
@@ -194,31 +256,70 @@ async def get_note_backlinks(note_id: int, db: Session = Depends(get_db)):
     
     # 2. Find sources via graph edges
     # We want notes that HAVE an edge pointing TO this note_id
-    stmt = select(Note).join(Link, Link.source_note_id == Note.id)\
+    stmt = select(Note.id, Note.title, Note.content).join(Link, Link.source_note_id == Note.id)\
                        .where(Link.target_note_id == note_id)
-    sources = (await db.execute(stmt)).scalars().all()
+    sources = await db.execute(stmt)
     
-    results = []
-    for src in sources:
-        results.append(BacklinkResponse(
-            source_id=src.id,
-            source_title=src.title,
-            snippet=extract_snippet(src.content, target.title)
-        ))
-    return results
+    results = [
+        BacklinkOut(source_id, source_title, extract_snippet(content, target.title))
+        for source_id, source_title, content in sources
+    ]
+    return MsgspecJSONResponse(results)
 
 @router.get("/tags", response_model=List[TagRead])
 async def get_tags(db: Session = Depends(get_db)):
-    stmt = select(Tag).order_by(Tag.name)
+    stmt = select(Tag.id, Tag.name).order_by(Tag.name)
     result = await db.execute(stmt)
-    return result.scalars().all()
+    return MsgspecJSONResponse([TagOut(tag_id, name) for tag_id, name in result])
+
+@router.get("/tags/top", response_model=List[TagCount])
+async def get_top_tags(limit: int = 20, db: Session = Depends(get_db)):
+    """
+    Most used tags, served from the maintained tag_stats counts.
+    """
+    stmt = select(Tag.id, Tag.name, TagStat.note_count)\
+        .join(TagStat, TagStat.tag_id == Tag.id)\
+        .order_by(TagStat.note_count.desc(), Tag.name)\
+        .limit(limit)
+    result = await db.execute(stmt)
+    return MsgspecJSONResponse([TagCountOut(tag_id, name, count) for tag_id, name, count in result])
+
+@router.get("/tags/{tag_id}/related", response_model=List[TagCount])
+async def get_related_tags(tag_id: int, limit: int = 20, db: Session = Depends(get_db)):
+    """
+    Tags that appear on the same notes as `tag_id`; note_count is the number of shared notes.
+    """
+    if not (await db.execute(select(Tag.id).where(Tag.id == tag_id))).scalar_one_or_none():
+        raise HTTPException(404, "Tag not found")
+
+    # Pairs are stored once (tag_a_id < tag_b_id), so look in both columns
+    other_id = case((TagCooccurrence.tag_a_id == tag_id, TagCooccurrence.tag_b_id), else_=TagCooccurrence.tag_a_id)
+    stmt = select(Tag.id, Tag.name, TagCooccurrence.note_count)\
+        .join(TagCooccurrence, Tag.id == other_id)\
+        .where((TagCooccurrence.tag_a_id == tag_id) | (TagCooccurrence.tag_b_id == tag_id))\
+        .order_by(TagCooccurrence.note_count.desc(), Tag.name)\
+        .limit(limit)
+    result = await db.execute(stmt)
+    return MsgspecJSONResponse([TagCountOut(other, name, count) for other, name, count in result])
+
+@router.get("/tags/{tag_id}/notes", response_model=List[NoteRead])
+async def get_tag_notes(tag_id: int, limit: int = 100, db: Session = Depends(get_db)):
+    if not (await db.execute(select(Tag.id).where(Tag.id == tag_id))).scalar_one_or_none():
+        raise HTTPException(404, "Tag not found")
+    stmt = select(*NOTE_LIST_COLUMNS)\
+        .join(NoteTag, NoteTag.note_id == Note.id)\
+        .where(NoteTag.tag_id == tag_id)\
+        .order_by(Note.updated_at.desc())\
+        .limit(limit)
+    return MsgspecJSONResponse(await fetch_note_list(stmt, db))
 
 # --- Helper: Graph Updater ---
-async def update_graph_links(note: Note, db: Session):
+async def update_graph_links(note: Note, db: Session) -> bool:
     """
     Parses [[WikiLinks]] in the content and updates the 'links' table.
+    Returns whether the set of link targets changed.
     """
-    if not note.content: return
+    if not note.content: return False
     
     # 1. Find all [[Title]] occurrences
     # Matches [[Title]] or [[Title|Alias]]
@@ -227,9 +328,12 @@ async def update_graph_links(note: Note, db: Session):
     
     # 2. Clear existing outgoing links
     from sqlalchemy import delete
+    stmt = select(Link.target_note_id).where(Link.source_note_id == note.id)
+    old_target_ids = set((await db.execute(stmt)).scalars().all())
     await db.execute(delete(Link).where(Link.source_note_id == note.id))
     
     # 3. Resolve Targets
+    new_target_ids = set()
     for target_title in unique_targets:
         # Find ID of target
         slug_candidate = slugify(target_title)
@@ -240,35 +344,24 @@ async def update_graph_links(note: Note, db: Session):
             # Create Edge
             link = Link(source_note_id=note.id, target_note_id=target_id)
             db.add(link)
+            new_target_ids.add(target_id)
+    return new_target_ids != old_target_ids
 
-async def update_tags(note: Note, db: Session):
+async def update_tags(note: Note, db: Session) -> bool:
     """
-    Parses #hashtags and updates note_tags table.
+    Parses #hashtags and updates note_tags plus the tag aggregates.
+    Returns whether the note's tag set changed.
     """
-    if not note.content: return
-
     # 1. Regex for #tag
     # Matches #word (alphanumeric + underscore)
-    raw_tags = re.findall(r'#(\w+)', note.content)
+    raw_tags = re.findall(r'#(\w+)', note.content or "")
     unique_tags = list(set(raw_tags))
     
-    # 2. Get existing NoteTags
-    tag_objs = []
-    for t_name in unique_tags:
-        # Find or create Tag
-        stmt = select(Tag).where(Tag.name == t_name)
-        tag = (await db.execute(stmt)).scalar_one_or_none()
-        if not tag:
-            tag = Tag(name=t_name)
-            db.add(tag)
-            await db.flush() # get ID
-        tag_objs.append(tag)
+    # 2. Current tags (read in this write transaction), then find or create the new ones
+    # (row-locked against orphan GC)
+    old_tag_ids = await tag_stats.note_tag_ids(db, note.id)
+    new_tag_ids = await tag_stats.resolve_tags(db, unique_tags, old_tag_ids)
         
-    # Update relationship
-    from sqlalchemy import delete
-    await db.execute(delete(NoteTag).where(NoteTag.note_id == note.id))
-    
-    for t in tag_objs:
-        nt = NoteTag(note_id=note.id, tag_id=t.id)
-        db.add(nt)
-
+    # 3. Diff against existing NoteTags (keeps counts/co-occurrence in sync, drops orphan tags)
+    await tag_stats.apply_note_tag_diff(db, note.id, old_tag_ids, new_tag_ids)
+    return new_tag_ids != old_tag_ids
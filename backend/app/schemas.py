@@ -9,6 +9,9 @@ class TagRead(BaseModel):
     class Config:
         from_attributes = True
 
+class TagCount(TagRead):
+    note_count: int
+
 class NoteBase(BaseModel):
     title: str
     content: Optional[str] = ""
@@ -39,6 +42,16 @@ class BacklinkResponse(BaseModel):
     source_title: str
     snippet: str
 
+class RenderedNote(BaseModel):
+    id: int
+    html: str
+    content_hash: str
+
+class AttachmentUsage(BaseModel):
+    note_id: Optional[int] = None
+    attachment_count: int
+    total_bytes: int
+
 class RevisionRead(BaseModel):
     id: int
     note_id: int
@@ -0,0 +1,78 @@
+"""
+Fast response layer for read-heavy endpoints.
+
+List and graph endpoints fetch Core row tuples, pack them into pre-declared
+msgspec Structs and encode them in one C-level pass. This skips per-row pydantic
+validation and the generic `jsonable_encoder` walk. Each Struct mirrors the JSON
+contract of its pydantic counterpart in `schemas.py`, so the routes can keep
+their `response_model` for OpenAPI docs.
+"""
+from datetime import datetime
+from typing import List, Optional, Union
+
+import msgspec
+from fastapi.responses import Response
+
+
+class TagOut(msgspec.Struct):
+    id: int
+    name: str
+
+
+class TagCountOut(msgspec.Struct):
+    id: int
+    name: str
+    note_count: int
+
+
+class NoteOut(msgspec.Struct):
+    # Field order matches schemas.NoteRead
+    title: str
+    content: Optional[str]
+    visibility: Optional[str]
+    id: int
+    slug: str
+    updated_at: datetime
+    owner_id: Optional[int]
+    is_favorite: bool
+    tags: List[TagOut]
+
+
+class BacklinkOut(msgspec.Struct):
+    source_id: int
+    source_title: str
+    snippet: str
+
+
+class GraphNodeOut(msgspec.Struct, omit_defaults=True):
+    id: Union[int, str]
+    title: str
+    group: str
+    type: str
+    # Only present once the server-side layout has placed the node
+    x: Optional[float] = None
+    y: Optional[float] = None
+
+
+class GraphLinkOut(msgspec.Struct):
+    source: Union[int, str]
+    target: Union[int, str]
+    type: str
+
+
+class GraphOut(msgspec.Struct):
+    nodes: List[GraphNodeOut]
+    links: List[GraphLinkOut]
+    tags: List[GraphNodeOut]
+    tagLinks: List[GraphLinkOut]
+
+
+_encoder = msgspec.json.Encoder()
+
+
+class MsgspecJSONResponse(Response):
+    """JSON response encoded with msgspec; returning it bypasses response_model validation."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return _encoder.encode(content)
@@ -0,0 +1,342 @@
+"""
+Attachment file storage and garbage collection.
+
+Files are stored under UPLOAD_DIR in two levels of hashed subdirectories
+(`ab/cd/<uuid>.<ext>`), so no single directory grows past a few dozen entries
+even with millions of uploads. Files left by the old flat layout are moved
+into their shard by the leader before its first GC pass (`migrate_flat_layout`,
+idempotent); until then `resolve_path` falls back to the flat location.
+
+An attachment is owned by the first note whose content references it
+(`claim_attachments`). A note gives its attachments up when a save removes the
+reference or the note is deleted; they are then unowned ("released"), like a
+fresh upload that no note has saved yet. The same image can be pasted into
+several notes, so released attachments are handed to another note that still
+references it before anything is deleted.
+
+The leader worker runs `reconcile` periodically. It reclaims, in batches:
+- released attachment rows older than UPLOAD_GC_GRACE_S (row and file), or
+  reassigns them to a note that references them
+- attachment rows whose file is missing on disk (row)
+- files with no attachment row, e.g. from a failed commit (file)
+References are looked up with one scan of the notes per batch, on a reader,
+before the writer is taken. A released row is deleted only once it has been
+found unreferenced for UPLOAD_GC_GRACE_S, so cutting an image and pasting it
+back a few saves later never loses it. Files younger than UPLOAD_GC_GRACE_S
+are never reclaimed, because an upload writes its file before it commits its
+row. Rows are never dropped for missing files while UPLOAD_DIR looks unmounted
+(no shard directories), and at most UPLOAD_GC_MAX_ROW_DELETES per pass.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from sqlalchemy import select, update, delete, func, or_
+
+from . import config
+from .database import AsyncSessionLocal
+from .models import Attachment, Note
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = config.UPLOAD_DIR
+ATTACHMENT_URL = re.compile(r'/api/attachments/([\w.-]+)')
+
+
+def shard_dir(filename: str) -> str:
+    digest = hashlib.md5(filename.encode("utf-8")).hexdigest()
+    return os.path.join(UPLOAD_DIR, digest[:2], digest[2:4])
+
+
+def path_for(filename: str) -> str:
+    return os.path.join(shard_dir(filename), filename)
+
+
+def resolve_path(filename: str) -> str:
+    """Sharded path, or the pre-sharding flat path if the file has not been migrated yet."""
+    path = path_for(filename)
+    if not os.path.exists(path):
+        legacy_path = os.path.join(UPLOAD_DIR, filename)
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+
+def write_file(filename: str, data: bytes) -> str:
+    """Writes to a temp name and renames, so readers and the GC never see partial files."""
+    directory = shard_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    tmp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def remove_files(filenames: Iterable[str]):
+    _remove_paths(path_for(filename) for filename in filenames)
+
+
+def _remove_paths(paths: Iterable[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _has_shards() -> bool:
+    """Whether UPLOAD_DIR contains any shard directories (i.e. looks like the real volume)."""
+    if not os.path.isdir(UPLOAD_DIR):
+        return False
+    return any(entry.is_dir() and len(entry.name) == 2 for entry in os.scandir(UPLOAD_DIR))
+
+
+def _iter_files() -> Iterator[Tuple[str, str, float]]:
+    """Yields (filename, path, mtime) for every sharded file, leftover temp files included."""
+    for first in os.scandir(UPLOAD_DIR):
+        if not first.is_dir():
+            continue
+        for second in os.scandir(first.path):
+            if not second.is_dir():
+                continue
+            for entry in os.scandir(second.path):
+                if entry.is_file():
+                    yield entry.name, entry.path, entry.stat().st_mtime
+
+
+def migrate_flat_layout() -> int:
+    """Moves files from the top level of UPLOAD_DIR into their shard. Returns the number moved."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    moved = 0
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.is_file() and not entry.name.startswith("."):
+            os.makedirs(shard_dir(entry.name), exist_ok=True)
+            os.replace(entry.path, path_for(entry.name))
+            moved += 1
+    if moved:
+        logger.info("Moved %d uploads into sharded directories", moved)
+    return moved
+
+
+async def claim_attachments(db, note: Note):
+    """
+    Assigns unowned attachments referenced in the note's content to the note,
+    so usage is reported per note, and releases the ones it no longer references
+    (the GC hands those to another referencing note or deletes them).
+    """
+    filenames = set(ATTACHMENT_URL.findall(note.content or ""))
+    if filenames:
+        await db.execute(
+            update(Attachment)
+            .where(Attachment.filename.in_(filenames), Attachment.note_id.is_(None))
+            .values(note_id=note.id)
+        )
+    await db.execute(
+        update(Attachment)
+        .where(Attachment.note_id == note.id, Attachment.filename.not_in(filenames))
+        .values(note_id=None)
+    )
+
+
+async def find_referencing_notes(db, filenames: Iterable[str]) -> Dict[str, int]:
+    """
+    Maps each of `filenames` to the lowest id of a note whose content references it.
+    One pass over the notes that embed any attachment, however many filenames.
+    """
+    wanted = set(filenames)
+    heirs: Dict[str, int] = {}
+    if not wanted:
+        return heirs
+    stmt = (
+        select(Note.id, Note.content)
+        .where(Note.content.contains("/api/attachments/"))
+        .order_by(Note.id)
+        .execution_options(yield_per=500)
+    )
+    async for note_id, content in await db.stream(stmt):
+        for filename in wanted.intersection(ATTACHMENT_URL.findall(content)):
+            heirs.setdefault(filename, note_id)
+    return heirs
+
+
+async def note_usage(db, note_ids: List[int] = None, limit: int = None):
+    """(note_id, attachment_count, total_bytes) rows, largest first. note_id None groups unowned files."""
+    stmt = (
+        select(Attachment.note_id, func.count(Attachment.id), func.coalesce(func.sum(Attachment.size_bytes), 0))
+        .group_by(Attachment.note_id)
+        .order_by(func.sum(Attachment.size_bytes).desc())
+    )
+    if note_ids is not None:
+        stmt = stmt.where(Attachment.note_id.in_(note_ids))
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return (await db.execute(stmt)).all()
+
+
+# --- Garbage collection ---
+
+async def _delete_rows(db, rows):
+    await db.execute(delete(Attachment).where(Attachment.id.in_([row.id for row in rows])))
+    await db.commit()
+
+
+# Released attachment id -> when the GC first found it unreferenced (leader-local)
+_unreferenced_since: Dict[int, float] = {}
+
+
+def _released():
+    """Attachments without a live owner: never claimed, released, or owned by a deleted note."""
+    owner_exists = select(Note.id).where(Note.id == Attachment.note_id).exists()
+    return or_(Attachment.note_id.is_(None), ~owner_exists)
+
+
+async def _reclaim_released(batch_size: int) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=config.UPLOAD_GC_GRACE_S)
+    now = time.monotonic()
+    seen: Set[int] = set()
+    total, last_id = 0, 0
+    while True:
+        # 1. Candidates and their references, from a reader snapshot
+        async with AsyncSessionLocal() as db:
+            stmt = (
+                select(Attachment.id, Attachment.filename)
+                .where(Attachment.id > last_id, _released(), Attachment.created_at < cutoff)
+                .order_by(Attachment.id)
+                .limit(batch_size)
+            )
+            rows = (await db.execute(stmt)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            heirs = await find_referencing_notes(db, [row.filename for row in rows])
+        seen.update(row.id for row in rows)
+
+        by_heir: Dict[int, List[int]] = {}
+        expired = []
+        for row in rows:
+            if row.filename in heirs:
+                by_heir.setdefault(heirs[row.filename], []).append(row.id)
+                _unreferenced_since.pop(row.id, None)
+            elif now - _unreferenced_since.setdefault(row.id, now) >= config.UPLOAD_GC_GRACE_S:
+                expired.append(row.id)
+        if not by_heir and not expired:
+            continue
+
+        # 2. Apply, re-checking on the writer that each row is still released
+        # (a save may have claimed it since) and that its heir still exists
+        async with AsyncSessionLocal(info={"writer": True}) as db:
+            for heir, ids in by_heir.items():
+                heir_exists = select(Note.id).where(Note.id == heir).exists()
+                await db.execute(
+                    update(Attachment)
+                    .where(Attachment.id.in_(ids), _released(), heir_exists)
+                    .values(note_id=heir)
+                    .execution_options(synchronize_session=False)
+                )
+            filenames = []
+            if expired:
+                stmt = select(Attachment.id, Attachment.filename)\
+                    .where(Attachment.id.in_(expired), _released())\
+                    .with_for_update()
+                doomed = (await db.execute(stmt)).all()
+                if doomed:
+                    await db.execute(delete(Attachment).where(Attachment.id.in_([row.id for row in doomed])))
+                filenames = [row.filename for row in doomed]
+            await db.commit()
+        # Files go only after the rows are gone, so a failed commit loses nothing
+        await asyncio.to_thread(remove_files, filenames)
+        for attachment_id in expired:
+            _unreferenced_since.pop(attachment_id, None)
+        total += len(filenames)
+
+    # Forget rows that were claimed or deleted elsewhere since the last pass
+    for attachment_id in _unreferenced_since.keys() - seen:
+        del _unreferenced_since[attachment_id]
+    return total
+
+
+async def _reclaim_missing_files(batch_size: int) -> int:
+    if not await asyncio.to_thread(_has_shards):
+        async with AsyncSessionLocal() as db:
+            if (await db.execute(select(Attachment.id).limit(1))).first() is not None:
+                logger.warning("%s has no shard directories but attachments exist; "
+                               "not treating their files as missing", UPLOAD_DIR)
+        return 0
+
+    total, last_id = 0, 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            stmt = (
+                select(Attachment.id, Attachment.filename)
+                .where(Attachment.id > last_id)
+                .order_by(Attachment.id)
+                .limit(batch_size)
+            )
+            rows = (await db.execute(stmt)).all()
+            if not rows:
+                return total
+            last_id = rows[-1].id
+            exists = await asyncio.to_thread(lambda: [os.path.exists(resolve_path(row.filename)) for row in rows])
+            missing = [row for row, found in zip(rows, exists) if not found]
+            if total + len(missing) > config.UPLOAD_GC_MAX_ROW_DELETES:
+                logger.warning("More than %d attachment files missing; deleting no more rows this pass",
+                               config.UPLOAD_GC_MAX_ROW_DELETES)
+                missing = missing[:config.UPLOAD_GC_MAX_ROW_DELETES - total]
+            if missing:
+                await _delete_rows(db, missing)
+                total += len(missing)
+            if total >= config.UPLOAD_GC_MAX_ROW_DELETES:
+                return total
+
+
+async def _reclaim_unreferenced_files(batch_size: int) -> int:
+    cutoff = time.time() - config.UPLOAD_GC_GRACE_S
+    candidates = await asyncio.to_thread(
+        lambda: [(name, path) for name, path, mtime in _iter_files() if mtime < cutoff]
+    )
+    total = 0
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        async with AsyncSessionLocal() as db:
+            stmt = select(Attachment.filename).where(Attachment.filename.in_([name for name, _ in batch]))
+            known = set((await db.execute(stmt)).scalars().all())
+        orphans = [path for name, path in batch if name not in known]
+        await asyncio.to_thread(_remove_paths, orphans)
+        total += len(orphans)
+    return total
+
+
+async def reconcile(batch_size: int = None):
+    """One full pass over rows and files. Returns counts of what was reclaimed."""
+    batch_size = batch_size or config.UPLOAD_GC_BATCH_SIZE
+    result = {
+        "released_attachments": await _reclaim_released(batch_size),
+        "missing_files": await _reclaim_missing_files(batch_size),
+        "orphan_files": await _reclaim_unreferenced_files(batch_size),
+    }
+    if any(result.values()):
+        logger.info("Upload GC reclaimed %s", result)
+    return result
+
+
+async def run_gc():
+    """
+    Leader job: every UPLOAD_GC_INTERVAL_S, moves any flat-layout files into
+    their shards and reconciles. Unmigrated files are still found through
+    `resolve_path`, so a failed migration never makes them look missing.
+    """
+    while True:
+        try:
+            await asyncio.to_thread(migrate_flat_layout)
+            await reconcile()
+        except Exception:
+            logger.exception("Upload GC pass failed")
+        await asyncio.sleep(config.UPLOAD_GC_INTERVAL_S)
@@ -0,0 +1,214 @@
+"""
+Tag aggregates: per-tag note counts and tag co-occurrence counts.
+
+Both tables are maintained incrementally from the tag write path
+(`apply_note_tag_diff`), so tag clouds and "related tags" never need a
+GROUP BY over note_tags at read time. Tags that lose their last note are
+garbage-collected in the same transaction.
+
+The diff is only correct if the note's current tags are read in the same
+transaction that applies it, so callers use a writer session
+(`database.get_write_db`) and read them with `note_tag_ids`, which also
+row-locks the note against a concurrent save on Postgres. On SQLite that
+transaction holds the write lock (BEGIN IMMEDIATE) from its first statement.
+
+Reusing a tag and garbage-collecting it must not interleave across
+transactions (on Postgres a writer could attach a note to a tag another
+transaction is deleting). Both paths therefore take row locks on the tags
+involved, in id order, before touching note_tags or the aggregates.
+
+`check_tag_stats` compares both tables with a recount from note_tags
+(see benchmarks/check_tag_stats.py).
+"""
+from itertools import combinations
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import select, insert, update, delete, func, tuple_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from .models import Note, Tag, NoteTag, TagStat, TagCooccurrence, NodePosition
+
+
+def _pairs(tag_ids: Iterable[int]) -> Set[Tuple[int, int]]:
+    return set(combinations(sorted(tag_ids), 2))
+
+
+async def note_tag_ids(db, note_id: int) -> Set[int]:
+    """The note's current tag ids. Call inside the write transaction that applies the diff."""
+    await db.execute(select(Note.id).where(Note.id == note_id).with_for_update())
+    stmt = select(NoteTag.tag_id).where(NoteTag.note_id == note_id)
+    return set((await db.execute(stmt)).scalars().all())
+
+
+async def resolve_tags(db, names: Iterable[str], held_ids: Iterable[int] = ()) -> Set[int]:
+    """
+    Returns the ids of the tags called `names`, creating missing ones.
+
+    Locks those tags and `held_ids` (the note's current tags, which may be
+    garbage-collected) in one id-ordered statement, so they cannot be deleted
+    underneath this transaction.
+    """
+    names, held_ids = set(names), set(held_ids)
+    if not names and not held_ids:
+        return set()
+    stmt = (
+        select(Tag.id, Tag.name)
+        .where(or_(Tag.name.in_(names), Tag.id.in_(held_ids)))
+        .order_by(Tag.id)
+        .with_for_update()
+    )
+    by_name = {name: tag_id for tag_id, name in await db.execute(stmt)}
+
+    for name in sorted(names - by_name.keys()):
+        try:
+            async with db.begin_nested():
+                tag = Tag(name=name)
+                db.add(tag)
+        except IntegrityError:
+            # Created by a concurrent transaction that has since committed
+            stmt = select(Tag.id).where(Tag.name == name).with_for_update()
+            by_name[name] = (await db.execute(stmt)).scalar_one()
+        else:
+            by_name[name] = tag.id
+    return {by_name[name] for name in names}
+
+
+async def lock_tags(db, tag_ids: Iterable[int]):
+    """Row-locks tags in id order (a no-op on SQLite)."""
+    tag_ids = set(tag_ids)
+    if tag_ids:
+        await db.execute(select(Tag.id).where(Tag.id.in_(tag_ids)).order_by(Tag.id).with_for_update())
+
+
+async def apply_note_tag_diff(db, note_id: int, old_ids: Set[int], new_ids: Set[int]):
+    """
+    Moves a note's tags from `old_ids` to `new_ids`.
+    Updates note_tags, tag_stats and tag_cooccurrence, and drops orphaned tags.
+    """
+    added = new_ids - old_ids
+    removed = old_ids - new_ids
+    if not added and not removed:
+        return
+    # Usually already held via resolve_tags; delete_note relies on this
+    await lock_tags(db, removed)
+
+    # 1. Association rows
+    if removed:
+        await db.execute(delete(NoteTag).where(NoteTag.note_id == note_id, NoteTag.tag_id.in_(removed)))
+    if added:
+        await db.execute(insert(NoteTag), [{"note_id": note_id, "tag_id": t} for t in added])
+
+    # 2. Per-tag note counts (SQL-side increments so concurrent writers can't lose updates)
+    if added:
+        await db.execute(update(TagStat).where(TagStat.tag_id.in_(added))
+                         .values(note_count=TagStat.note_count + 1))
+        existing = set((await db.execute(select(TagStat.tag_id).where(TagStat.tag_id.in_(added)))).scalars())
+        missing = added - existing
+        if missing:
+            await db.execute(insert(TagStat), [{"tag_id": t, "note_count": 1} for t in missing])
+    if removed:
+        await db.execute(update(TagStat).where(TagStat.tag_id.in_(removed))
+                         .values(note_count=TagStat.note_count - 1))
+
+    # 3. Co-occurrence counts
+    old_pairs, new_pairs = _pairs(old_ids), _pairs(new_ids)
+    added_pairs = new_pairs - old_pairs
+    removed_pairs = old_pairs - new_pairs
+    pair_key = tuple_(TagCooccurrence.tag_a_id, TagCooccurrence.tag_b_id)
+    if added_pairs:
+        await db.execute(update(TagCooccurrence).where(pair_key.in_(added_pairs))
+                         .values(note_count=TagCooccurrence.note_count + 1))
+        existing = set(map(tuple, await db.execute(
+            select(TagCooccurrence.tag_a_id, TagCooccurrence.tag_b_id).where(pair_key.in_(added_pairs))
+        )))
+        missing = added_pairs - existing
+        if missing:
+            await db.execute(insert(TagCooccurrence), [
+                {"tag_a_id": a, "tag_b_id": b, "note_count": 1} for a, b in missing
+            ])
+    if removed_pairs:
+        await db.execute(update(TagCooccurrence).where(pair_key.in_(removed_pairs))
+                         .values(note_count=TagCooccurrence.note_count - 1))
+        await db.execute(delete(TagCooccurrence).where(pair_key.in_(removed_pairs), TagCooccurrence.note_count <= 0))
+
+    # 4. Garbage-collect tags whose last note is gone
+    if removed:
+        stmt = select(TagStat.tag_id).where(TagStat.tag_id.in_(removed), TagStat.note_count <= 0)
+        orphans = set((await db.execute(stmt)).scalars())
+        if orphans:
+            await delete_tags(db, orphans)
+
+
+async def delete_tags(db, tag_ids: Set[int]):
+    """Removes tags together with their aggregates and layout positions."""
+    await db.execute(delete(TagCooccurrence).where(
+        TagCooccurrence.tag_a_id.in_(tag_ids) | TagCooccurrence.tag_b_id.in_(tag_ids)
+    ))
+    await db.execute(delete(TagStat).where(TagStat.tag_id.in_(tag_ids)))
+    await db.execute(delete(NoteTag).where(NoteTag.tag_id.in_(tag_ids)))
+    await db.execute(delete(NodePosition).where(NodePosition.node_type == "tag", NodePosition.ref_id.in_(tag_ids)))
+    await db.execute(delete(Tag).where(Tag.id.in_(tag_ids)))
+
+
+async def rebuild_tag_stats(db):
+    """
+    Recomputes both aggregate tables from note_tags and drops tags without notes.
+    Used to backfill databases created before the aggregates existed.
+    """
+    await db.execute(delete(TagCooccurrence))
+    await db.execute(delete(TagStat))
+
+    stats_stmt, pairs_stmt = _recount_stmts()
+    await db.execute(insert(TagStat).from_select(["tag_id", "note_count"], stats_stmt))
+    await db.execute(insert(TagCooccurrence).from_select(["tag_a_id", "tag_b_id", "note_count"], pairs_stmt))
+
+    stmt = select(Tag.id).where(Tag.id.not_in(select(TagStat.tag_id)))
+    orphans = set((await db.execute(stmt)).scalars())
+    if orphans:
+        await delete_tags(db, orphans)
+    await db.commit()
+
+
+def _recount_stmts():
+    nt_a, nt_b = aliased(NoteTag), aliased(NoteTag)
+    stats = select(NoteTag.tag_id, func.count()).group_by(NoteTag.tag_id)
+    pairs = (
+        select(nt_a.tag_id, nt_b.tag_id, func.count())
+        .join(nt_b, (nt_a.note_id == nt_b.note_id) & (nt_a.tag_id < nt_b.tag_id))
+        .group_by(nt_a.tag_id, nt_b.tag_id)
+    )
+    return stats, pairs
+
+
+async def check_tag_stats(db) -> List[str]:
+    """
+    Compares the incremental aggregates with what `rebuild_tag_stats` would
+    produce. Returns one line per mismatch; empty when they agree.
+    """
+    stats_stmt, pairs_stmt = _recount_stmts()
+    problems = []
+
+    def compare(label: str, actual: Dict, expected: Dict):
+        for key in sorted(actual.keys() | expected.keys()):
+            if actual.get(key) != expected.get(key):
+                problems.append(f"{label} {key}: stored {actual.get(key)}, recounted {expected.get(key)}")
+
+    compare("tag_stats",
+            dict((await db.execute(select(TagStat.tag_id, TagStat.note_count))).all()),
+            dict((await db.execute(stats_stmt)).all()))
+    compare("tag_cooccurrence",
+            {(a, b): n for a, b, n in await db.execute(
+                select(TagCooccurrence.tag_a_id, TagCooccurrence.tag_b_id, TagCooccurrence.note_count))},
+            {(a, b): n for a, b, n in await db.execute(pairs_stmt)})
+    orphans = (await db.execute(select(Tag.id).where(Tag.id.not_in(select(NoteTag.tag_id))))).scalars().all()
+    problems.extend(f"tag {tag_id}: no notes" for tag_id in orphans)
+    return problems
+
+
+async def ensure_tag_stats(db):
+    """Startup hook: backfills the aggregates if they have never been built."""
+    has_stats = (await db.execute(select(TagStat.tag_id).limit(1))).first()
+    has_tags = (await db.execute(select(Tag.id).limit(1))).first()
+    if has_tags and not has_stats:
+        await rebuild_tag_stats(db)
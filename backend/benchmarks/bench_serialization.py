@@ -0,0 +1,135 @@
+"""
+Serialization benchmark for the read endpoints.
+
+Seeds a throwaway SQLite database with N notes (plus links and tags) and times
+each endpoint two ways:
+  - legacy: ORM entities -> pydantic response_model -> jsonable_encoder -> json
+  - fast:   Core row tuples -> msgspec Structs -> msgspec encoder (current code)
+The graph is also timed in its columnar binary encoding (see graph_codec.py).
+
+Usage (from backend/):
+    python -m benchmarks.bench_serialization [--sizes 1000 10000 100000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import select, insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker, selectinload
+
+from app.database import Base
+from app.models import Note, Link, Tag, NoteTag
+from app.schemas import NoteRead, BacklinkResponse
+from app.routers import notes as notes_router, graph as graph_router
+
+
+async def seed(session_factory, size: int):
+    rng = random.Random(size)
+    async with session_factory() as db:
+        await db.execute(insert(Note), [
+            {"id": i, "title": f"Note {i}", "slug": f"note-{i}", "owner_id": 1, "visibility": "team",
+             "is_favorite": False, "content": f"Body of note {i} linking [[Note 1]] #tag{i % 50}"}
+            for i in range(1, size + 1)
+        ])
+        await db.execute(insert(Tag), [{"id": t, "name": f"tag{t}"} for t in range(1, 51)])
+        await db.execute(insert(NoteTag), [{"note_id": i, "tag_id": i % 50 + 1} for i in range(1, size + 1)])
+        await db.execute(insert(Link), [
+            {"source_note_id": i, "target_note_id": 1 if i % 10 == 0 else rng.randint(1, size)}
+            for i in range(1, size + 1)
+        ])
+        await db.commit()
+
+
+async def legacy_notes(db, limit: int) -> bytes:
+    stmt = select(Note).options(selectinload(Note.tags)).order_by(Note.updated_at.desc()).limit(limit)
+    notes = (await db.execute(stmt)).scalars().all()
+    validated = TypeAdapter(List[NoteRead]).validate_python(notes, from_attributes=True)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+async def legacy_backlinks(db, note_id: int) -> bytes:
+    target = (await db.execute(select(Note).where(Note.id == note_id))).scalar_one()
+    stmt = select(Note).join(Link, Link.source_note_id == Note.id).where(Link.target_note_id == note_id)
+    sources = (await db.execute(stmt)).scalars().all()
+    results = [
+        BacklinkResponse(source_id=src.id, source_title=src.title,
+                         snippet=notes_router.extract_snippet(src.content, target.title))
+        for src in sources
+    ]
+    validated = TypeAdapter(List[BacklinkResponse]).validate_python(results)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+async def legacy_graph(db) -> bytes:
+    nodes = [{"id": r.id, "title": r.title, "group": r.visibility or "public", "type": "note"}
+             for r in await db.execute(select(Note.id, Note.title, Note.visibility))]
+    links = [{"source": r.source_note_id, "target": r.target_note_id, "type": "note-link"}
+             for r in await db.execute(select(Link.source_note_id, Link.target_note_id))]
+    tags = [{"id": f"tag-{r.id}", "title": f"#{r.name}", "group": "tag", "type": "tag"}
+            for r in await db.execute(select(Tag.id, Tag.name))]
+    tag_links = [{"source": r.note_id, "target": f"tag-{r.tag_id}", "type": "tag-link"}
+                 for r in await db.execute(select(NoteTag.note_id, NoteTag.tag_id))]
+    payload = {"nodes": nodes, "links": links, "tags": tags, "tagLinks": tag_links}
+    return json.dumps(jsonable_encoder(payload)).encode()
+
+
+async def uncached_graph(db, binary: bool = False):
+    # Measure encoding, not the per-worker payload cache
+    graph_router.graph_cache.clear()
+    if binary:
+        return await graph_router.get_graph_binary(None, db)
+    return await graph_router.get_graph_json(db)
+
+
+async def timed(session_factory, fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        async with session_factory() as db:
+            start = time.perf_counter()
+            result = await fn(db)
+            if hasattr(result, "body"):
+                result = result.body
+            assert result
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def run(sizes: List[int], repeat: int):
+    print(f"{'endpoint':<22}{'rows':>8}{'legacy ms':>12}{'fast ms':>10}{'speedup':>9}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+            await seed(session_factory, size)
+
+            cases = [
+                ("GET /notes", lambda db: legacy_notes(db, size),
+                 lambda db: notes_router.get_notes(limit=size, db=db)),
+                ("GET /notes/1/backlinks", lambda db: legacy_backlinks(db, 1),
+                 lambda db: notes_router.get_note_backlinks(1, db=db)),
+                ("GET /graph", legacy_graph, lambda db: uncached_graph(db)),
+                ("GET /graph (binary)", legacy_graph, lambda db: uncached_graph(db, binary=True)),
+            ]
+            for name, legacy, fast in cases:
+                legacy_s = await timed(session_factory, legacy, repeat)
+                fast_s = await timed(session_factory, fast, repeat)
+                print(f"{name:<22}{size:>8}{legacy_s * 1000:>12.1f}{fast_s * 1000:>10.1f}{legacy_s / fast_s:>8.1f}x")
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.repeat))
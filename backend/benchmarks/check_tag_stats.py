@@ -0,0 +1,86 @@
+"""
+Consistency check for the incremental tag aggregates.
+
+Runs concurrent creates, autosaves and deletes through the note routes against
+a scratch database, then compares tag_stats / tag_cooccurrence with a recount
+from note_tags (`tag_stats.check_tag_stats`, i.e. what `rebuild_tag_stats`
+would produce). Exits non-zero on any mismatch.
+
+The profile comes from the usual environment variables (see app/config.py):
+
+    python -m benchmarks.check_tag_stats [--notes 50] [--operations 500]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+
+async def run(args) -> int:
+    from app import database, tag_stats
+    from app.database import Base
+    from app.routers import notes as notes_router
+    from app.schemas import NoteCreate, NoteUpdate
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    rng = random.Random(args.seed)
+    tags = [f"check{t}" for t in range(args.tags)]
+    note_ids = []
+
+    def content() -> str:
+        return "Body " + " ".join(f"#{t}" for t in rng.sample(tags, rng.randint(0, 4)))
+
+    async def call(route, *route_args):
+        async with database.AsyncSessionLocal(info={"writer": True}) as db:
+            return await route(*route_args, db=db)
+
+    async def worker(worker_id: int):
+        for i in range(args.operations // args.workers):
+            roll = rng.random()
+            if roll < 0.2 or not note_ids:
+                note = await call(notes_router.create_note,
+                                  NoteCreate(title=f"Check {worker_id}-{i}", content=content()))
+                note_ids.append(note.id)
+                continue
+            # Workers take notes out of the pool while they use them: the routes
+            # reload a note after committing and 404 if it was deleted meanwhile
+            note_id = note_ids.pop(rng.randrange(len(note_ids)))
+            if roll < 0.85:
+                await call(notes_router.update_note, note_id, NoteUpdate(content=content()))
+                note_ids.append(note_id)
+            else:
+                await call(notes_router.delete_note, note_id)
+
+    for i in range(args.notes):
+        note = await call(notes_router.create_note, NoteCreate(title=f"Check seed {i}", content=content()))
+        note_ids.append(note.id)
+    await asyncio.gather(*[worker(w) for w in range(args.workers)])
+
+    async with database.AsyncSessionLocal() as db:
+        problems = await tag_stats.check_tag_stats(db)
+    for problem in problems:
+        print(problem)
+    print(f"{args.operations} operations by {args.workers} workers: "
+          f"{'OK' if not problems else f'{len(problems)} mismatches'}")
+    await database.engine.dispose()
+    await database.read_engine.dispose()
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=50)
+    parser.add_argument("--operations", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--tags", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Default to a scratch SQLite file so the dev database is left alone
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'check.db')}")
+    sys.exit(asyncio.run(run(args)))
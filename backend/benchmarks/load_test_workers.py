@@ -0,0 +1,124 @@
+"""
+Read-throughput load test across worker counts.
+
+For each worker count, starts `uvicorn app.main:app --workers N` against a
+seeded scratch database, then drives it from several client processes that
+loop over GET /api/notes, /api/graph and /api/tags/top. Prints requests/s and
+the speedup over one worker, which should be close to linear up to the number
+of cores.
+
+Usage (from backend/):
+    python -m benchmarks.load_test_workers [--workers 1 2 4] [--duration 10]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+PATHS = ["/api/notes", "/api/graph", "/api/tags/top"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed(base_url: str, notes: int):
+    with httpx.Client(base_url=base_url, timeout=30) as client:
+        for i in range(notes):
+            content = f"Note {i} links [[Note {i // 2}]] #topic{i % 20} #team{i % 5}"
+            client.post("/api/notes", json={"title": f"Note {i}", "content": content})
+
+
+def wait_ready(base_url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(base_url + "/").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+def client_process(base_url: str, duration: float, concurrency: int, results):
+    async def run():
+        count = 0
+        deadline = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            async def loop(offset: int):
+                nonlocal count
+                i = offset
+                while time.perf_counter() < deadline:
+                    response = await client.get(PATHS[i % len(PATHS)])
+                    response.raise_for_status()
+                    count += 1
+                    i += 1
+            await asyncio.gather(*[loop(i) for i in range(concurrency)])
+        results.put(count)
+    asyncio.run(run())
+
+
+def measure(workers: int, args, db_dir: str) -> float:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DATABASE_URL=f"sqlite+aiosqlite:///{os.path.join(db_dir, 'load.db')}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        wait_ready(base_url)
+        if not args.seeded:
+            seed(base_url, args.notes)
+            args.seeded = True
+
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=client_process, args=(base_url, args.duration, args.concurrency, results))
+            for _ in range(args.clients)
+        ]
+        for proc in clients:
+            proc.start()
+        total = sum(results.get() for _ in clients)
+        for proc in clients:
+            proc.join()
+        return total / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="Client processes generating load")
+    parser.add_argument("--concurrency", type=int, default=16, help="In-flight requests per client")
+    parser.add_argument("--notes", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+    args.seeded = False
+
+    print(f"{os.cpu_count()} CPUs available")
+    print(f"{'workers':>8}{'req/s':>10}{'speedup':>9}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as db_dir:
+        for workers in args.workers:
+            rate = measure(workers, args, db_dir)
+            baseline = baseline or rate
+            print(f"{workers:>8}{rate:>10.1f}{rate / baseline:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 import React, { useEffect, useState } from "react";
 import Link from "next/link";
+import { useSearchParams } from "next/navigation";
 import axios from "axios";
 import { FileText, Search, Loader2 } from "lucide-react";
 
@@ -17,9 +18,17 @@ import { useNotes } from "@/context/NotesContext";
 export default function AllNotesPage() {
     const [notes, setNotes] = useState<NoteSummary[]>([]);
     const [loading, setLoading] = useState(true);
-    const [search, setSearch] = useState("");
+    const searchParams = useSearchParams();
+    // Prefill from the URL (e.g. "#tag" links in server-rendered notes: /notes?search=%23tag)
+    const initialSearch = searchParams.get("search") || "";
+    const [search, setSearch] = useState(initialSearch);
     const { selectedTag } = useNotes();
 
+    // Update state if URL param changes
+    useEffect(() => {
+        setSearch(initialSearch);
+    }, [initialSearch]);
+
     useEffect(() => {
         // Determine the query
         // If selectedTag is present, we override the search to be #tagName
@@ -15,6 +15,7 @@ import {
     Layers,
     Move
 } from "lucide-react";
+import { decodeGraph, GRAPH_BINARY_MEDIA_TYPE } from "./graphCodec";
 
 // Dynamically import ForceGraph2D so it doesn't break SSR
 const ForceGraph2D = dynamic(() => import("react-force-graph-2d"), {
@@ -104,9 +105,14 @@ export default function NetworkGraph() {
     useEffect(() => {
         const fetchGraph = async () => {
             try {
-                const res = await fetch("http://localhost:8000/api/graph");
+                // Prefer the compact columnar encoding; the server falls back to JSON
+                const res = await fetch("http://localhost:8000/api/graph", {
+                    headers: { Accept: `${GRAPH_BINARY_MEDIA_TYPE}, application/json;q=0.9` }
+                });
                 if (!res.ok) throw new Error("Failed to load graph");
-                const jsonData = await res.json();
+                const jsonData = res.headers.get("content-type")?.startsWith(GRAPH_BINARY_MEDIA_TYPE)
+                    ? decodeGraph(await res.arrayBuffer())
+                    : await res.json();
 
                 // Calculate link counts for each node
                 const linkCounts: Record<number | string, number> = {};
@@ -208,6 +214,9 @@ export default function NetworkGraph() {
         setFilteredData({ nodes: nodesWithUpdatedCounts, links: freshLinks });
     }, [data, settings.searchQuery, settings.showOrphans, settings.showTags]);
 
+    // Nodes arrive with precomputed x/y once the backend has laid out the graph
+    const hasServerLayout = filteredData.nodes.length > 0 && filteredData.nodes.every(n => n.x !== undefined && n.y !== undefined);
+
     // 3. Responsive Sizing
     useEffect(() => {
         function handleResize() {
@@ -493,9 +502,9 @@ export default function NetworkGraph() {
                     onNodeClick={handleNodeClick}
                     onNodeHover={handleNodeHover}
 
-                    // Physics
-                    cooldownTicks={100}
-                    d3AlphaDecay={0.02}
+                    // Physics: server-laid-out graphs only need a short local fine-tune
+                    cooldownTicks={hasServerLayout ? 20 : 100}
+                    d3AlphaDecay={hasServerLayout ? 0.1 : 0.02}
                     d3VelocityDecay={0.3}
                 />
             </div>
@@ -0,0 +1,88 @@
+// Decoder for the columnar graph encoding served by GET /api/graph
+// (Accept: application/vnd.corporate-obsidian.graph+binary).
+// Layout: design_docs/graph_binary_format.md
+
+export const GRAPH_BINARY_MEDIA_TYPE = "application/vnd.corporate-obsidian.graph+binary";
+
+const NODE_TAG = 1;
+const EDGE_TAG_LINK = 1;
+const FLAG_POSITIONS = 1;
+
+interface DecodedNode {
+    id: number | string;
+    title: string;
+    group: string;
+    type: string;
+    x?: number;
+    y?: number;
+}
+
+interface DecodedLink {
+    source: number | string;
+    target: number | string;
+    type: string;
+}
+
+export interface DecodedGraph {
+    nodes: DecodedNode[];
+    links: DecodedLink[];
+    tags: DecodedNode[];
+    tagLinks: DecodedLink[];
+}
+
+const pad4 = (n: number) => (n + 3) & ~3;
+
+function readStringTable(buffer: ArrayBuffer, offset: number, count: number): [string[], number] {
+    const offsets = new Uint32Array(buffer, offset, count + 1);
+    offset += 4 * (count + 1);
+    const bytes = new Uint8Array(buffer, offset, offsets[count]);
+    const decoder = new TextDecoder();
+    const strings = new Array<string>(count);
+    for (let i = 0; i < count; i++) {
+        strings[i] = decoder.decode(bytes.subarray(offsets[i], offsets[i + 1]));
+    }
+    return [strings, offset + pad4(offsets[count])];
+}
+
+// Decodes into the same shape as the JSON response so callers can treat both alike
+export function decodeGraph(buffer: ArrayBuffer): DecodedGraph {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== "COG1") throw new Error(`Unknown graph encoding: ${magic}`);
+    const n = view.getUint32(4, true);
+    const m = view.getUint32(8, true);
+    const groupCount = view.getUint32(12, true);
+    const hasPositions = (view.getUint32(16, true) & FLAG_POSITIONS) !== 0;
+    let offset = 20;
+
+    const ids = new Int32Array(buffer, offset, n); offset += 4 * n;
+    const kinds = new Uint8Array(buffer, offset, n); offset += pad4(n);
+    const groupIndex = new Uint8Array(buffer, offset, n); offset += pad4(n);
+    const xs = new Float32Array(buffer, offset, n); offset += 4 * n;
+    const ys = new Float32Array(buffer, offset, n); offset += 4 * n;
+    let titles: string[], groups: string[];
+    [titles, offset] = readStringTable(buffer, offset, n);
+    [groups, offset] = readStringTable(buffer, offset, groupCount);
+    const sources = new Uint32Array(buffer, offset, m); offset += 4 * m;
+    const targets = new Uint32Array(buffer, offset, m); offset += 4 * m;
+    const edgeKinds = new Uint8Array(buffer, offset, m);
+
+    const graph: DecodedGraph = { nodes: [], links: [], tags: [], tagLinks: [] };
+    const nodeIds = new Array<number | string>(n);
+    for (let i = 0; i < n; i++) {
+        const isTag = kinds[i] === NODE_TAG;
+        nodeIds[i] = isTag ? `tag-${ids[i]}` : ids[i];
+        const node: DecodedNode = { id: nodeIds[i], title: titles[i], group: groups[groupIndex[i]], type: isTag ? "tag" : "note" };
+        if (hasPositions && !Number.isNaN(xs[i])) {
+            node.x = xs[i];
+            node.y = ys[i];
+        }
+        (isTag ? graph.tags : graph.nodes).push(node);
+    }
+    for (let i = 0; i < m; i++) {
+        const isTagLink = edgeKinds[i] === EDGE_TAG_LINK;
+        const link = { source: nodeIds[sources[i]], target: nodeIds[targets[i]], type: isTagLink ? "tag-link" : "note-link" };
+        (isTagLink ? graph.tagLinks : graph.links).push(link);
+    }
+    return graph;
+}